@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import socketserver
+
+import pandas as pd
+
+from generate_synthetic_inputs import generate_inputs, check_sizes
+
+try:
+    import resource  # Peak memory of the pipeline process, not available on Windows
+except ImportError:
+    resource = None
+
+# Benchmarks pears_coalition_survey_cleaning.py on synthetic inputs of increasing size
+# Each run times the script's stages, records peak memory and appends the results to a JSON history file
+# Emails are sent to a local SMTP sink instead of Office 365
+
+# Calculate the path to the root directory of this script
+ROOT_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '.'))
+
+
+# Class for handling one SMTP connection to the sink
+# Accepts any login and message, counting the messages received
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        self.reply('220 localhost SMTP sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip().upper()
+            if command.startswith('EHLO'):
+                self.reply('250-localhost')
+                self.reply('250 AUTH PLAIN LOGIN')
+            elif command.startswith('AUTH'):
+                self.reply('235 Authentication successful')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b'.\n', b''):
+                    pass
+                with self.server.lock:
+                    self.server.messages += 1
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+# Class for a local SMTP server that discards every message
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPSinkHandler)
+        self.messages = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+# Function to run the cleaning script on a directory of inputs
+# Returns a dict of the total wall time, peak memory, stage timings and number of emails sent
+# inputs_dir: string for the directory of input workbooks
+# work_dir: string for a directory for outputs, caches and timings
+# fq: string for the fiscal quarter of the inputs
+# use_sheet_cache: boolean, True to let the script cache parsed sheets and store validation results
+# notify_rate: float for the script's email rate limit, per second
+def run_pipeline(inputs_dir, work_dir, fq, use_sheet_cache=False, notify_rate=1000.0):
+    sink = SMTPSink()
+    timings_path = work_dir + '/stage_timings.json'
+    os.makedirs(work_dir + '/outputs', exist_ok=True)
+    # Every run sends all of its emails instead of skipping those sent by the previous run
+    if os.path.exists(work_dir + '/outbox.db'):
+        os.remove(work_dir + '/outbox.db')
+    env = dict(os.environ,
+               PEARS_EXPORT_PATH=inputs_dir,
+               PEARS_INPUTS_PATH=inputs_dir,
+               PEARS_OUT_PATH=work_dir + '/outputs',
+               PEARS_CACHE_PATH=work_dir + '/sheet_cache',
+               PEARS_RUN_LOG_PATH=work_dir + '/run_logs',
+               PEARS_USE_SHEET_CACHE=str(use_sheet_cache),
+               PEARS_STORE_STAGE_RESULTS=str(use_sheet_cache),
+               PEARS_HISTORY_PATH=work_dir + '/history.db',
+               PEARS_OUTBOX_PATH=work_dir + '/outbox.db',
+               PEARS_FISCAL_QUARTER=fq,
+               PEARS_SMTP_HOST='127.0.0.1',
+               PEARS_SMTP_PORT=str(sink.server_address[1]),
+               PEARS_SMTP_USE_TLS='0',
+               PEARS_NOTIFY_RATE=str(notify_rate),
+               PEARS_NOTIFY_BURST=str(int(notify_rate)),
+               PEARS_STAGE_TIMINGS_PATH=timings_path)
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, ROOT_DIR + '/pears_coalition_survey_cleaning.py'], env=env,
+                               stdout=subprocess.DEVNULL)
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        peak_memory_mb = usage.ru_maxrss / 1024
+    else:
+        process.wait()
+        peak_memory_mb = None
+    wall_time = time.perf_counter() - started
+    sink.shutdown()
+    sink.server_close()
+
+    stages = []
+    if os.path.exists(timings_path):
+        with open(timings_path) as f:
+            stages = json.load(f)
+    return {'returncode': process.returncode, 'wall_time': wall_time, 'peak_memory_mb': peak_memory_mb,
+            'stages': stages, 'emails_sent': sink.messages}
+
+
+# Function to get the current git commit of this repository, if available
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+# Function to print how a result compares with the latest run of the same size in the history
+# result: dict for the current benchmark result
+# history: list of dicts for previous benchmark results
+def print_comparison(result, history):
+    previous = [r for r in history if r['sizes'] == result['sizes'] and r['sheet_cache'] == result['sheet_cache']
+                and r['returncode'] == 0]
+    print(str(result['sizes']) + ': ' + format(result['wall_time'], '.2f') + 's, peak ' +
+          format(result['peak_memory_mb'] or 0, '.0f') + ' MB')
+    if not previous:
+        return
+    last = pd.DataFrame(previous[-1]['stages']).set_index('stage')['wall_time']
+    current = pd.DataFrame(result['stages']).set_index('stage')['wall_time']
+    change = pd.DataFrame({'previous': last, 'current': current})
+    change['change'] = (change['current'] / change['previous'] - 1).map('{:+.0%}'.format)
+    print('Compared with ' + previous[-1]['timestamp'] + ' (' + previous[-1]['commit'] + '):')
+    print(change.to_string())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the coalition survey cleaning script on synthetic inputs.')
+    parser.add_argument('--coalitions', type=int, nargs='+', default=[1000, 10000],
+                        help='numbers of coalitions to benchmark')
+    parser.add_argument('--staff', type=int, default=500, help='number of staff')
+    parser.add_argument('--responses-per-coalition', type=float, default=1.5)
+    parser.add_argument('--fq', default='Q4', help='fiscal quarter of the synthetic survey')
+    parser.add_argument('--sheet-cache', action='store_true', help='run twice and time the run with warm caches')
+    parser.add_argument('--notify-rate', type=float, default=1000.0,
+                        help='email rate limit passed to the script, per second')
+    parser.add_argument('--history', default=ROOT_DIR + '/benchmark_history.json',
+                        help='JSON file the results are appended to')
+    args = parser.parse_args()
+    # Fail before generating any inputs rather than partway through the sizes
+    try:
+        for n_coalitions in args.coalitions:
+            check_sizes(n_coalitions, args.staff, args.responses_per_coalition)
+    except ValueError as e:
+        parser.error(str(e))
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history) as f:
+            history = json.load(f)
+
+    for n_coalitions in args.coalitions:
+        with tempfile.TemporaryDirectory() as work_dir:
+            started = time.perf_counter()
+            sizes = generate_inputs(work_dir + '/inputs', n_coalitions=n_coalitions, n_staff=args.staff,
+                                    responses_per_coalition=args.responses_per_coalition, fq=args.fq)
+            generate_time = time.perf_counter() - started
+            if args.sheet_cache:
+                run_pipeline(work_dir + '/inputs', work_dir, args.fq, True, args.notify_rate)
+            result = run_pipeline(work_dir + '/inputs', work_dir, args.fq, args.sheet_cache, args.notify_rate)
+        del sizes['survey_fq']
+        result = dict({'timestamp': pd.Timestamp.now().isoformat(timespec='seconds'),
+                       'commit': git_commit(),
+                       'python': platform.python_version(),
+                       'pandas': pd.__version__,
+                       'sizes': sizes,
+                       'sheet_cache': args.sheet_cache,
+                       'generate_time': generate_time}, **result)
+        if result['returncode'] != 0:
+            print(str(sizes) + ': the cleaning script failed with exit code ' + str(result['returncode']))
+        else:
+            print_comparison(result, history)
+        history.append(result)
+
+    with open(args.history, 'w') as f:
+        json.dump(history, f, indent=2)
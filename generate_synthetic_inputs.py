@@ -0,0 +1,208 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+# Generates synthetic versions of the input workbooks read by pears_coalition_survey_cleaning.py
+# Sheet names and the columns used for data cleaning match the PEARS exports and staff list,
+# filler columns stand in for the rest of each export
+# Values are drawn with numpy so that large inputs can be generated quickly
+
+# Maximum number of data rows in an Excel worksheet
+MAX_ROWS = 1048575
+
+fq_lookup = pd.DataFrame({'fq': ['Q1', 'Q2', 'Q3', 'Q4'],
+                          'survey_fq': ['Quarter 1 (October-December)', 'Quarter 2 (January-March)',
+                                        'Quarter 3 (April-June)', 'Quarter 4 (July-September)']})
+
+first_names = np.array(['Alex', 'Jordan', 'Taylor', 'Morgan', 'Casey', 'Riley', 'Jamie', 'Avery', 'Quinn', 'Drew',
+                        'Maria', 'James', 'Linda', 'David', 'Sarah', 'Kevin', 'Aisha', 'Wei', 'Carlos', 'Priya'])
+last_names = np.array(['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Lopez',
+                       'Wilson', 'Anderson', 'Thomas', 'Moore', 'Martin', 'Lee', 'Clark', 'Lewis', 'Walker', 'Hall',
+                       'Young'])
+
+
+# Function to write a dict of dataframes to an Excel workbook, one sheet per dataframe
+# Rows are streamed to disk with xlsxwriter's constant_memory mode so large sheets fit in memory
+# file_path: string for the workbook's filepath
+# dfs_dict: dict of sheet names to dataframes
+def write_workbook(file_path, dfs_dict):
+    workbook = xlsxwriter.Workbook(file_path, {'constant_memory': True,
+                                               'default_date_format': 'YYYY-MM-DD HH:MM:SS'})
+    for sheetname, df in dfs_dict.items():
+        if len(df) > MAX_ROWS:
+            raise ValueError(sheetname + ' has ' + str(len(df)) + ' rows, more than an Excel worksheet can hold.')
+        worksheet = workbook.add_worksheet(sheetname)
+        worksheet.write_row(0, 0, df.columns)
+        for row, record in enumerate(df.astype(object).where(df.notnull(), None).itertuples(index=False, name=None)):
+            worksheet.write_row(row + 1, 0, record)
+    workbook.close()
+
+
+# Function to check that the requested sizes can be generated
+# Coalitions and staff must fit in one worksheet, larger survey responses and meetings sheets are capped at MAX_ROWS
+# Raises ValueError describing the first invalid size
+# n_coalitions: int for the number of coalitions
+# n_staff: int for the number of staff
+# responses_per_coalition: float for the number of survey responses per coalition
+def check_sizes(n_coalitions, n_staff, responses_per_coalition):
+    if not 1 <= n_coalitions <= MAX_ROWS:
+        raise ValueError('The number of coalitions must be between 1 and ' + str(MAX_ROWS) + ', got ' +
+                         str(n_coalitions) + '.')
+    if not 1 <= n_staff <= MAX_ROWS:
+        raise ValueError('The number of staff must be between 1 and ' + str(MAX_ROWS) + ', got ' + str(n_staff) + '.')
+    if responses_per_coalition < 0:
+        raise ValueError('The number of responses per coalition can\'t be negative, got ' +
+                         str(responses_per_coalition) + '.')
+
+
+# Function to generate staff names and emails
+# rng: numpy Generator
+# n: int for the number of staff
+# start: int for the first staff number, keeps emails unique across calls
+def make_staff(rng, n, start=0):
+    first = rng.choice(first_names, n)
+    last = rng.choice(last_names, n)
+    number = np.arange(start, start + n).astype(str)
+    emails = pd.Series(first).str.lower() + '.' + pd.Series(last).str.lower() + number + '@illinois.edu'
+    return pd.DataFrame({'first_name': first, 'last_name': last, 'email': emails})
+
+
+# Function to generate every input workbook in a directory
+# out_dir: string for the directory to write the workbooks to
+# n_coalitions: int for the number of coalitions in the Coalitions export
+# n_staff: int for the number of staff in the staff list
+# responses_per_coalition: float for the number of survey responses per coalition across all quarters,
+#   capped so the responses fit in one worksheet
+# fq: string for the fiscal quarter of the survey responses workbook, e.g. 'Q4'
+# survey_filler_columns: int for the number of unused survey question columns
+# seed: int for the random number generator's seed
+def generate_inputs(out_dir,
+                    n_coalitions=1000,
+                    n_staff=500,
+                    responses_per_coalition=1.5,
+                    fq='Q4',
+                    survey_filler_columns=40,
+                    seed=0):
+    check_sizes(n_coalitions, n_staff, responses_per_coalition)
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Unit counties lookup: 102 counties in 27 units
+    counties = np.array(['County' + str(i) for i in range(102)])
+    unit_counties = pd.DataFrame({'County': counties, 'Unit #': rng.integers(1, 28, len(counties))})
+    write_workbook(out_dir + '/Illinois Extension Unit Counties.xlsx', {'Sheet1': unit_counties})
+
+    # Staff list, split across the SNAP-Ed, HEAT, FCS State Office and CPHP sheets
+    staff = make_staff(rng, n_staff)
+    sheet = rng.choice(['SNAP-Ed Staff List', 'HEAT Project Staff', 'FCS State Office', 'CPHP Staff List'],
+                       n_staff, p=[0.6, 0.1, 0.1, 0.2])
+    staff['NAME'] = staff['last_name'] + ', ' + staff['first_name']
+    staff['TITLE'] = rng.choice(['Educator', 'Coordinator', 'Specialist'], n_staff)
+    staff_sheets = {}
+    for sheetname in ['SNAP-Ed Staff List', 'HEAT Project Staff', 'FCS State Office']:
+        staff_sheets[sheetname] = staff.loc[sheet == sheetname, ['NAME', 'TITLE', 'email']].rename(
+            columns={'email': 'E-MAIL'})
+    staff_sheets['CPHP Staff List'] = staff.loc[sheet == 'CPHP Staff List',
+                                                ['last_name', 'first_name', 'email']].rename(
+        columns={'last_name': 'Last Name', 'first_name': 'First Name', 'email': 'Email Address'})
+    educators = staff.sample(27, replace=n_staff < 27, random_state=seed)
+    staff_sheets["RE's and CD's"] = pd.DataFrame({'UNIT #': np.arange(1, 28),
+                                                  'REGIONAL EDUCATOR': educators['NAME'].values,
+                                                  'NETID/E-MAIL': educators['email'].values})
+    write_workbook(out_dir + '/FY22_INEP_Staff_List.xlsx', staff_sheets)
+
+    # Coalitions export, about 5% of coalitions belong to former staff
+    former_staff = make_staff(rng, max(n_staff // 20, 1), start=n_staff)
+    owners = np.where(rng.random(n_coalitions) < 0.95, rng.choice(staff['email'], n_coalitions),
+                      rng.choice(former_staff['email'], n_coalitions))
+    unit_format = rng.choice(['county', 'district', 'unit'], n_coalitions)
+    unit_county = rng.choice(counties, n_coalitions)
+    coalition_unit = np.where(unit_format == 'county', pd.Series(unit_county) + ' (County)',
+                              np.where(unit_format == 'district', pd.Series(unit_county) + ' (District)',
+                                       'Unit ' + pd.Series(rng.integers(1, 28, n_coalitions)).astype(str)))
+    coalition_ids = np.arange(10000, 10000 + n_coalitions)
+    coalition_names = 'Coalition ' + pd.Series(rng.choice(last_names, n_coalitions)) + ' ' + pd.Series(
+        coalition_ids).astype(str)
+    coalition_names[rng.random(n_coalitions) < 0.01] = 'TEST Coalition'
+    created = pd.Timestamp('2021-10-01') + pd.to_timedelta(rng.integers(0, 300, n_coalitions), unit='D')
+    coalitions = pd.DataFrame({
+        'coalition_id': coalition_ids,
+        'coalition_name': coalition_names,
+        'reported_by': pd.Series(rng.choice(first_names, n_coalitions)) + ' ' + rng.choice(last_names, n_coalitions),
+        'reported_by_email': owners,
+        'created': created,
+        'modified': created + pd.to_timedelta(rng.integers(0, 60, n_coalitions), unit='D'),
+        'program_area': rng.choice(['SNAP-Ed', 'Family Consumer Science', 'EFNEP'], n_coalitions, p=[0.6, 0.3, 0.1]),
+        'coalition_unit': coalition_unit,
+        'coalition_type': rng.choice(['Community', 'School', 'Health'], n_coalitions),
+        'relationship_depth': rng.choice(['Network', 'Cooperation', 'Coordination', 'Coalition', 'Collaboration'],
+                                         n_coalitions),
+        'on_hiatus': rng.choice(['Yes', 'No'], n_coalitions, p=[0.1, 0.9]),
+        'action_plan_name': 'Action Plan ' + pd.Series(rng.integers(1, 50, n_coalitions)).astype(str),
+    })
+    n_meetings = min(n_coalitions * 2, MAX_ROWS)
+    meetings = pd.DataFrame({
+        'coalition_id': rng.choice(coalition_ids, n_meetings),
+        'meeting_id': np.arange(n_meetings),
+        'start_date': pd.Timestamp('2021-10-01') + pd.to_timedelta(rng.integers(0, 365, n_meetings), unit='D'),
+        'meeting_purpose': rng.choice(['Planning', 'Implementation', 'Evaluation'], n_meetings),
+    })
+    write_workbook(out_dir + '/Coalition_Export.xlsx', {'Coalition Data': coalitions, 'Meetings': meetings})
+
+    # Coalition Survey responses accumulated across the fiscal year
+    # Most coalition IDs are exact matches, some have extra text and some don't exist
+    n_responses = int(n_coalitions * responses_per_coalition)
+    if n_responses > MAX_ROWS:
+        print('Capping the ' + str(n_responses) + ' survey responses at the ' + str(MAX_ROWS) +
+              ' rows a worksheet can hold.')
+        n_responses = MAX_ROWS
+    survey_fq = fq_lookup.loc[fq_lookup['fq'] == fq, 'survey_fq'].item()
+    response_coalitions = rng.choice(coalition_ids, n_responses)
+    id_answers = pd.Series(response_coalitions).astype(str)
+    id_kind = rng.random(n_responses)
+    id_answers[id_kind < 0.1] = 'ID ' + id_answers[id_kind < 0.1]
+    id_answers[id_kind > 0.95] = pd.Series(rng.integers(1, 9999, n_responses)).astype(str)[id_kind > 0.95]
+    responses = pd.DataFrame({
+        'Program Activity ID': rng.integers(100000, 999999, n_responses),
+        'Program Name': 'Program ' + pd.Series(rng.integers(1, 500, n_responses)).astype(str),
+        'Unique PEARS ID of Response': np.arange(n_responses),
+        'staff_email': rng.choice(staff['email'], n_responses),
+        'What is the Coalition ID from the PEARS Coalition module that corresponds to this survey?': id_answers,
+        'coalition_name': 'Coalition ' + pd.Series(response_coalitions).astype(str),
+        'For which Quarter are you completing this survey?&nbsp;': rng.choice(fq_lookup['survey_fq'], n_responses,
+                                                                               p=[0.2, 0.2, 0.2, 0.4]),
+    })
+    responses.loc[rng.random(n_responses) < 0.01, 'coalition_name'] = 'TEST'
+    for i in range(survey_filler_columns):
+        responses['Survey Question ' + str(i + 1)] = rng.choice(['Yes', 'No', 'Somewhat', ''], n_responses)
+    write_workbook(out_dir + '/Responses By Survey - Coalition Survey - ' + fq + '.xlsx',
+                   {'Response Data': responses})
+
+    update_notes = pd.DataFrame({'Tab': ['Coalitions', 'Coalition Surveys'],
+                                 'Module': ['Coalitions', 'Program Activities'],
+                                 'Update': ['UPDATES', 'EVALUATION TAB UPDATES'],
+                                 'Notification': ['Coalition Survey missing', 'Coalition ID mismatch']})
+    write_workbook(out_dir + '/Update Notifications.xlsx', {'Quarterly Data Cleaning': update_notes})
+    return {'coalitions': n_coalitions, 'staff': n_staff, 'responses': n_responses, 'survey_fq': survey_fq}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic input workbooks for the coalition survey cleaning '
+                                                 'script.')
+    parser.add_argument('out_dir', help='directory to write the workbooks to')
+    parser.add_argument('--coalitions', type=int, default=1000, help='number of coalitions')
+    parser.add_argument('--staff', type=int, default=500, help='number of staff')
+    parser.add_argument('--responses-per-coalition', type=float, default=1.5,
+                        help='survey responses per coalition across all quarters')
+    parser.add_argument('--fq', default='Q4', choices=fq_lookup['fq'].tolist(), help='fiscal quarter of the survey')
+    parser.add_argument('--survey-filler-columns', type=int, default=40, help='unused survey question columns')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    try:
+        check_sizes(args.coalitions, args.staff, args.responses_per_coalition)
+    except ValueError as e:
+        parser.error(str(e))
+    print(generate_inputs(args.out_dir, args.coalitions, args.staff, args.responses_per_coalition, args.fq,
+                          args.survey_filler_columns, args.seed))
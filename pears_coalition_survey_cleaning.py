@@ -1,6 +1,35 @@
 import os
+import sys
+import argparse
+import glob
+import hashlib
+import json
+import re
+import string
+import cProfile
+import tracemalloc
+import multiprocessing
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import pandas as pd
 import numpy as np
+import xlsxwriter
+import openpyxl
+from openpyxl.cell.cell import ERROR_CODES
+
+try:
+    import pyarrow  # Parquet engine for the sheet cache
+except ImportError:
+    pyarrow = None
+
+try:
+    import resource  # Peak memory of each stage, not available on Windows
+except ImportError:
+    resource = None
 
 import smtplib
 import ssl
@@ -13,80 +42,709 @@ from email import encoders
 # Calculate the path to the root directory of this script
 ROOT_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '.'))
 
+
+# Function to read a setting that can be overridden by a PEARS_<NAME> environment variable
+# Used by benchmark_pipeline.py to run the script against synthetic inputs and a local SMTP server
+# name: string for the setting's name
+# default: value used if the environment variable isn't set, its type is used to convert the variable
+def setting(name, default):
+    value = os.environ.get('PEARS_' + name.upper())
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes')
+    if isinstance(default, (int, float)):
+        return type(default)(value)
+    return value
+
+
 # Define path to directory for reformatted PEARS module exports
 # Used output path from pears_nightly_export_reformatting.py
 # Otherwise, custom field labels will cause errors
 # pears_export_path = r"\path\to\reformatted_pears_data"
 # Script demo uses /example_inputs directory
-pears_export_path = ROOT_DIR + "/example_inputs"
-
-Coalitions_Export = pd.ExcelFile(pears_export_path + '/' + "Coalition_Export.xlsx")
-Coa_Data = pd.read_excel(Coalitions_Export, 'Coalition Data')
-Coa_Data = Coa_Data.loc[Coa_Data['program_area'].isin(['SNAP-Ed', 'Family Consumer Science'])]
-Coa_Data['coalition_id'] = Coa_Data['coalition_id'].astype(str)
-Coa_Meetings = pd.read_excel(Coalitions_Export, 'Meetings')
-Coa_Meetings['coalition_id'] = Coa_Meetings['coalition_id'].astype(str)
-Coa_Meetings['start_date'] = pd.to_datetime(Coa_Meetings['start_date'])
-Coa_Meetings = Coa_Meetings.sort_values(by='start_date').drop_duplicates(subset='coalition_id', keep='first')
-Coa_Meetings_Data = pd.merge(Coa_Data, Coa_Meetings[['coalition_id', 'start_date']], how='left', on='coalition_id')
-
-prev_month = (pd.to_datetime("today") - pd.DateOffset(months=1)).strftime('%m')
+pears_export_path = setting('export_path', ROOT_DIR + "/example_inputs")
+# Directory for the staff list, Update Notifications and unit counties workbooks
+inputs_path = setting('inputs_path', ROOT_DIR + "/example_inputs")
+# Directory the corrections and former staff reports are written to
+out_path = setting('out_path', ROOT_DIR + "/example_outputs")
+
+# Parsed workbook sheets are cached as Parquet files in /sheet_cache
+# Set use_sheet_cache to False to always parse the Excel workbooks
+use_sheet_cache = setting('use_sheet_cache', True)
+cache_path = setting('cache_path', ROOT_DIR + "/sheet_cache")
+# The results of the validation stages are also kept there, and reused while the export workbooks are unchanged
+# Set store_stage_results to False to always clean and validate the exports
+store_stage_results = setting('store_stage_results', True)
+
+# Metrics for each stage of the script are written to a JSON and CSV run log in /run_logs,
+# along with a CSV of every email's send outcome and latency
+run_log_path = setting('run_log_path', ROOT_DIR + "/run_logs")
+run_id = pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')
+# Path of an additional JSON file for the stage metrics (default: '', not written), used by benchmark_pipeline.py
+stage_timings_path = setting('stage_timings_path', '')
+# Set profile_stages to True to profile each stage with cProfile and tracemalloc
+# Profiles are written to /run_logs, cProfile output can be viewed with pstats or snakeviz
+profile_stages = setting('profile_stages', False)
+
+
+# Function to get the peak resident memory of this process in MB, or None if it can't be measured
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+# Class for recording metrics of consecutive stages of the script
+# Records wall time, CPU time of this process, rows in and out and the increase in peak resident memory
+# Starting a stage ends the previous one, metrics are written to the run log as each stage ends
+# name: string for the run log's filename prefix (default: None, run_id)
+class StageTimer:
+    def __init__(self, name=None):
+        self.name = run_id if name is None else name
+        self.metrics = []
+        self.current = None
+        self.profiler = None
+
+    # Start timing a stage
+    # stage: string for the stage's name
+    # rows_in: int for the number of rows the stage starts with (default: None)
+    def start(self, stage, rows_in=None):
+        self.stop()
+        self.current = {'run_id': self.name, 'stage': stage, 'rows_in': rows_in, 'rows_out': None,
+                        'started': pd.Timestamp.now().isoformat(timespec='seconds'),
+                        'peak_rss_mb': peak_rss_mb(), 'wall_time': time.perf_counter(),
+                        'cpu_time': time.process_time()}
+        if profile_stages:
+            tracemalloc.start()
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    # Stop timing the current stage, if any, and write the run log
+    # rows_out: int for the number of rows the stage ends with (default: None)
+    def stop(self, rows_out=None):
+        if self.current is None:
+            return
+        stage = self.current
+        stage['wall_time'] = time.perf_counter() - stage['wall_time']
+        stage['cpu_time'] = time.process_time() - stage['cpu_time']
+        stage['rows_out'] = rows_out
+        peak_before = stage.pop('peak_rss_mb')
+        stage['peak_rss_mb'] = peak_rss_mb()
+        stage['peak_rss_delta_mb'] = None if peak_before is None else stage['peak_rss_mb'] - peak_before
+        self.current = None
+        os.makedirs(run_log_path, exist_ok=True)
+        if self.profiler is not None:
+            self.profiler.disable()
+            profile_file = run_log_path + '/' + self.name + '_' + stage['stage'].replace(' ', '_')
+            self.profiler.dump_stats(profile_file + '.prof')
+            with open(profile_file + '_memory.txt', 'w') as f:
+                f.write('\n'.join(str(stat) for stat in tracemalloc.take_snapshot().statistics('lineno')[:50]))
+            tracemalloc.stop()
+            self.profiler = None
+        self.metrics.append(stage)
+        self.write(run_log_path + '/' + self.name + '_stages')
+        if stage_timings_path:
+            with open(stage_timings_path, 'w') as f:
+                json.dump(self.metrics, f, indent=2)
+
+    # Write the metrics of every finished stage to JSON and CSV files
+    # file_path: string for the filepath without an extension
+    def write(self, file_path):
+        with open(file_path + '.json', 'w') as f:
+            json.dump(self.metrics, f, indent=2)
+        pd.DataFrame(self.metrics).to_csv(file_path + '.csv', index=False)
+
+
+# Hashes of files already read during this run, keyed by (path, modified time, size)
+file_hashes = {}
+
+
+# Function to calculate the SHA-256 hash of a file's contents
+# file_path: string for the file's path
+def file_hash(file_path):
+    stat = os.stat(file_path)
+    key = (os.path.realpath(file_path), stat.st_mtime_ns, stat.st_size)
+    if key not in file_hashes:
+        h = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        file_hashes[key] = h.hexdigest()
+    return file_hashes[key]
+
+
+# Function to convert object columns holding more than one type (e.g. numeric and text IDs) to strings
+# Parquet columns must have a single type
+# df: dataframe of a parsed sheet
+def stringify_mixed_columns(df):
+    for col in df.columns[df.dtypes == object]:
+        if df[col].dropna().map(type).nunique() > 1:
+            df[col] = df[col].map(str, na_action='ignore')
+    return df
+
+
+# Number of matching rows converted to a dataframe at once by read_filtered_sheet
+read_chunk_size = 10000
+
+
+# Function to stream a sheet from an Excel workbook, keeping only the rows that pass a list of filters
+# Rows are read one at a time with openpyxl's read-only mode and tested before they're converted,
+# so memory grows with the matching rows instead of the whole sheet
+# Matching rows are converted to dataframes read_chunk_size rows at a time, with the same conversions as read_excel
+# file_path: string for the workbook's filepath
+# sheet_name: string for the sheet to read, or int for its position (default: 0, the first sheet)
+# usecols: list of the names of the columns to keep, in order (default: None, every column)
+# filters: list of (column, operator, value) tuples a row must pass (default: None, every row)
+#   operator is '==', 'in' for a list of values, or 'not contains' for a regex not found in text values
+def read_filtered_sheet(file_path, sheet_name=0, usecols=None, filters=None):
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True, keep_links=False)
+    try:
+        worksheet = workbook.worksheets[sheet_name] if isinstance(sheet_name, int) else workbook[sheet_name]
+        # Some workbooks record the wrong dimensions, which would cut rows short in read-only mode
+        worksheet.reset_dimensions()
+        rows = worksheet.iter_rows(values_only=True)
+        header = list(next(rows, ()))
+        columns = header if usecols is None else list(usecols)
+        missing = [column for column in columns + [f[0] for f in filters or []] if column not in header]
+        if missing:
+            raise ValueError('Columns not found in ' + os.path.basename(file_path) + ': ' + repr(missing))
+        positions = [header.index(column) for column in columns]
+
+        tests = []
+        for column, operator, value in filters or []:
+            position = header.index(column)
+            if operator == '==':
+                tests.append(lambda row, position=position, value=value: row[position] == value)
+            elif operator == 'in':
+                tests.append(lambda row, position=position, value=set(value): row[position] in value)
+            elif operator == 'not contains':
+                tests.append(lambda row, position=position, pattern=re.compile(value):
+                             not (isinstance(row[position], str) and pattern.search(row[position])))
+            else:
+                raise ValueError('Unknown filter operator: ' + operator)
+
+        chunks = []
+        chunk = []
+        for row in rows:
+            if len(row) < len(header):
+                row = row + (None,) * (len(header) - len(row))
+            if all(value is None for value in row) or not all(test(row) for test in tests):
+                continue
+            chunk.append([row[position] for position in positions])
+            if len(chunk) == read_chunk_size:
+                chunks.append(convert_rows(chunk, columns))
+                chunk = []
+        if chunk or not chunks:
+            chunks.append(convert_rows(chunk, columns))
+    finally:
+        workbook.close()
+    return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+
+
+# Function to convert rows of cell values to a dataframe the way read_excel does
+# Blank cells and error values (e.g. #N/A) are missing, whole numbers are integers and numeric columns are inferred
+# rows: list of lists of cell values
+# columns: list of column names
+def convert_rows(rows, columns):
+    rows = [['' if value is None else np.nan if isinstance(value, str) and value in ERROR_CODES else
+             int(value) if isinstance(value, float) and value.is_integer() else value for value in row]
+            for row in rows]
+    if not rows:
+        return pd.DataFrame(columns=columns, dtype=object)
+    return pd.io.parsers.TextParser(rows, names=columns, header=None).read()
+
+
+# Function to read a sheet from an Excel workbook, streaming it with read_filtered_sheet if it has filters
+# file_path: string for the workbook's filepath
+# sheet_name: string for the sheet to read (default: 0, the first sheet)
+# filters: list of (column, operator, value) tuples passed to read_filtered_sheet (default: None)
+# kwargs: additional keyword arguments passed to pd.read_excel or read_filtered_sheet
+def read_sheet(file_path, sheet_name=0, filters=None, **kwargs):
+    if filters:
+        return read_filtered_sheet(file_path, sheet_name, filters=filters, **kwargs)
+    return pd.read_excel(file_path, sheet_name=sheet_name, **kwargs)
+
+
+# Function to read a sheet from an Excel workbook using a cached Parquet copy if the workbook is unchanged
+# Cache files are keyed on the workbook's hash, the sheet name and the read options,
+# so a changed workbook only invalidates its own sheets
+# file_path: string for the workbook's filepath
+# sheet_name: string for the sheet to read (default: 0, the first sheet)
+# kwargs: additional keyword arguments passed to read_sheet
+def read_excel_cached(file_path, sheet_name=0, **kwargs):
+    if not use_sheet_cache or pyarrow is None:
+        return read_sheet(file_path, sheet_name=sheet_name, **kwargs)
+    sheet_key = '|'.join([os.path.realpath(file_path), str(sheet_name), repr(sorted(kwargs.items()))])
+    sheet_key = hashlib.sha256(sheet_key.encode()).hexdigest()[:16]
+    cache_file = cache_path + '/' + sheet_key + '_' + file_hash(file_path)[:16] + '.parquet'
+    try:
+        return pd.read_parquet(cache_file, memory_map=True)
+    except FileNotFoundError:
+        pass
+
+    df = stringify_mixed_columns(read_sheet(file_path, sheet_name=sheet_name, **kwargs))
+    os.makedirs(cache_path, exist_ok=True)
+    # Each process writes its own temporary file, which replaces the cache file in one step
+    temp_file = cache_file + '.' + str(os.getpid()) + '.tmp'
+    try:
+        df.to_parquet(temp_file)
+        os.replace(temp_file, cache_file)
+    except (ValueError, TypeError, FileNotFoundError):
+        # Sheets that can't be stored as Parquet (e.g. non-string column labels) are parsed every run
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        return df
+    # Remove cached copies of this sheet from previous versions of the workbook,
+    # keeping any copy another job wrote after this one
+    try:
+        written = os.stat(cache_file).st_mtime_ns
+    except FileNotFoundError:
+        # A newer version of the workbook was cached by another job in the meantime
+        return df
+    for stale_file in glob.glob(cache_path + '/' + sheet_key + '_*.parquet'):
+        try:
+            if stale_file != cache_file and os.stat(stale_file).st_mtime_ns < written:
+                os.remove(stale_file)
+        except FileNotFoundError:
+            pass
+    return df
+
 fq_lookup = pd.DataFrame({'fq': ['Q1', 'Q2', 'Q3', 'Q4'], 'month': ['12', '03', '06', '09'],
                           'survey_fq': ['Quarter 1 (October-December)', 'Quarter 2 (January-March)',
                                         'Quarter 3 (April-June)', 'Quarter 4 (July-September)']})
-fq = fq_lookup.loc[fq_lookup['month'] == prev_month, 'fq'].item()
-survey_fq = fq_lookup.loc[fq_lookup['month'] == prev_month, 'survey_fq'].item()
-
-Coa_Surveys_Path = pears_export_path + "/Responses By Survey - Coalition Survey - " + fq + ".xlsx"
-Coa_Surveys = pd.read_excel(Coa_Surveys_Path,
-                            sheet_name='Response Data')
-# filter Responses By Survey by Completed == ---- to export all responses
-Coa_Surveys = Coa_Surveys.loc[(Coa_Surveys['For which Quarter are you completing this survey?&nbsp;'] == survey_fq) &
-                              (~Coa_Surveys['coalition_name'].str.contains('(?i)TEST', regex=True, na=False)),
-                              ['Program Activity ID', 'Program Name', 'Unique PEARS ID of Response', 'staff_email',
-                               'What is the Coalition ID from the PEARS Coalition module that corresponds to this survey?',
-                               'coalition_name', 'For which Quarter are you completing this survey?&nbsp;']]
-Coa_Surveys = Coa_Surveys.rename(columns={'Program Activity ID': 'program_id',
-                                          'Program Name': 'program_name',
-                                          'staff_email': 'reported_by_email',
-                                          'What is the Coalition ID from the PEARS Coalition module that corresponds to this survey?': 'coalition_id',
-                                          'Unique PEARS ID of Response': 'response_id',
-                                          'For which Quarter are you completing this survey?&nbsp;': 'survey_quarter'})
-# Remove all characters besides digits from coalition_id
-Coa_Surveys['coalition_id'] = Coa_Surveys['coalition_id'].astype(str)
-Coa_Surveys.loc[~Coa_Surveys['coalition_id'].str.isnumeric(), 'coalition_id'] = Coa_Surveys['coalition_id'].str.extract(
-    '(\d+)', expand=False)
-# Auto export?
-# Responses by Survey filters: Name == Coalition Survey & Survey Status == Active
-# Export filters: Reporting Period == Extension 2021 & Type of Export == Individual Responses
+# Set fiscal_quarter (e.g. 'Q2') to clean a quarter other than the most recently completed one
+fiscal_quarter = setting('fiscal_quarter', '')
+# Set fiscal_year (e.g. 2022) to record a quarter older than the most recent fiscal_quarter in the corrections history
+fiscal_year = setting('fiscal_year', 0)
+
+
+# Function to get a fiscal quarter and the label used for it in the Coalition Survey
+# fq: string for the fiscal quarter, e.g. 'Q2' (default: '', the most recently completed quarter)
+def quarter_labels(fq=''):
+    if fq:
+        quarter = fq_lookup.loc[fq_lookup['fq'] == fq]
+    else:
+        # The last quarter to end before this month, e.g. Q4 (July-September) from October through December
+        prev_month = (pd.to_datetime("today") - pd.DateOffset(months=1)).month
+        quarter = fq_lookup.loc[fq_lookup['month'] == format(prev_month - prev_month % 3 or 12, '02d')]
+    return quarter['fq'].item(), quarter['survey_fq'].item()
+
+
+# Function to get the fiscal year of the most recent occurrence of a fiscal quarter, up to the last completed quarter
+# Fiscal years end in September, e.g. Q1 of fiscal year 2023 is October-December 2022
+# fq: string for the fiscal quarter, e.g. 'Q2'
+def quarter_fiscal_year(fq):
+    prev_month = pd.to_datetime("today") - pd.DateOffset(months=1)
+    end_month = int(fq_lookup.loc[fq_lookup['fq'] == fq, 'month'].item())
+    year = prev_month.year if end_month <= prev_month.month else prev_month.year - 1
+    return year + 1 if end_month == 12 else year
+
+
+# Survey response columns used for data cleaning and their renamed labels
+survey_columns = {'Program Activity ID': 'program_id',
+                  'Program Name': 'program_name',
+                  'Unique PEARS ID of Response': 'response_id',
+                  'staff_email': 'reported_by_email',
+                  'What is the Coalition ID from the PEARS Coalition module that corresponds to this survey?': 'coalition_id',
+                  'coalition_name': 'coalition_name',
+                  'For which Quarter are you completing this survey?&nbsp;': 'survey_quarter'}
+
+
+# Function to get the sheets the pipeline can read, keyed by name
+# usecols limits parsing to the columns used for data cleaning (None parses every column)
+# Survey responses are filtered to the quarter's responses and TEST coalitions are excluded as the sheet is read,
+# since the workbook accumulates responses across the fiscal year
+# export_dir: string for the directory of reformatted PEARS module exports
+# inputs_dir: string for the directory of the staff list, Update Notifications and unit counties workbooks
+# fq: string for the fiscal quarter of the Coalition Survey responses workbook, e.g. 'Q2'
+def input_sources(export_dir, inputs_dir, fq):
+    Coalitions_Export_Path = export_dir + '/' + "Coalition_Export.xlsx"
+    Coa_Surveys_Path = export_dir + "/Responses By Survey - Coalition Survey - " + fq + ".xlsx"
+    FY22_INEP_Staff = inputs_dir + "/FY22_INEP_Staff_List.xlsx"
+    survey_fq = quarter_labels(fq)[1]
+    return {
+        'Coa_Data': {'file_path': Coalitions_Export_Path, 'sheet_name': 'Coalition Data',
+                     'usecols': ['coalition_id', 'coalition_name', 'reported_by_email', 'coalition_unit',
+                                 'program_area', 'relationship_depth', 'created', 'modified', 'on_hiatus']},
+        'Coa_Meetings': {'file_path': Coalitions_Export_Path, 'sheet_name': 'Meetings',
+                         'usecols': ['coalition_id', 'start_date']},
+        'Coa_Surveys': {'file_path': Coa_Surveys_Path, 'sheet_name': 'Response Data',
+                        'usecols': list(survey_columns),
+                        'filters': [('For which Quarter are you completing this survey?&nbsp;', '==', survey_fq),
+                                    ('coalition_name', 'not contains', '(?i)TEST')]},
+        'Update_Notes': {'file_path': inputs_dir + "/Update Notifications.xlsx",
+                         'sheet_name': 'Quarterly Data Cleaning', 'usecols': None},
+        'SNAP_Ed_Staff': {'file_path': FY22_INEP_Staff, 'sheet_name': 'SNAP-Ed Staff List',
+                          'usecols': ['NAME', 'E-MAIL']},
+        'HEAT_Staff': {'file_path': FY22_INEP_Staff, 'sheet_name': 'HEAT Project Staff',
+                       'usecols': ['NAME', 'E-MAIL']},
+        'State_Staff': {'file_path': FY22_INEP_Staff, 'sheet_name': 'FCS State Office',
+                        'usecols': ['NAME', 'E-MAIL']},
+        'CPHP_Staff': {'file_path': FY22_INEP_Staff, 'sheet_name': 'CPHP Staff List',
+                       'usecols': ['Last Name', 'First Name', 'Email Address']},
+        'RE_Staff': {'file_path': FY22_INEP_Staff, 'sheet_name': "RE's and CD's",
+                     'usecols': ['UNIT #', 'REGIONAL EDUCATOR', 'NETID/E-MAIL']},
+        'unit_counties': {'file_path': inputs_dir + "/Illinois Extension Unit Counties.xlsx",
+                          'sheet_name': 0, 'usecols': ['County', 'Unit #']}
+    }
+
+
+# Function to read input sheets in parallel
+# Returns a dict of each source's name to its dataframe
+# sources: dict of names to read_excel_cached arguments, from input_sources
+# max_workers: int for the number of worker processes (default: None, the number of CPUs)
+def load_inputs(sources, max_workers=None):
+    if use_sheet_cache and pyarrow is not None:
+        # Hash each workbook once so forked workers inherit the hashes
+        for file_path in {source['file_path'] for source in sources.values()}:
+            file_hash(file_path)
+    if batch_shared:
+        # Batch jobs read with threads, so all of a job's memory is in its own worker process
+        executor = ThreadPoolExecutor(max_workers)
+    elif 'fork' in multiprocessing.get_all_start_methods():
+        executor = ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('fork'))
+    else:
+        # Spawned worker processes would have to import this script again, so read with threads instead
+        executor = ThreadPoolExecutor(max_workers)
+    with executor:
+        futures = {name: executor.submit(read_excel_cached, **source) for name, source in sources.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+
+# Emails are stored as Arrow-backed strings, or as categoricals if pyarrow isn't installed
+email_dtype = pd.StringDtype('pyarrow') if pyarrow is not None else 'category'
+
+# Column types applied to input sheets as they're read
+# IDs are nullable integers, low-cardinality fields are categoricals and emails use email_dtype
+# Columns not listed keep the type they were read with
+input_schemas = {
+    'Coa_Data': {'coalition_id': 'Int64', 'reported_by_email': email_dtype, 'coalition_unit': 'category',
+                 'program_area': 'category', 'relationship_depth': 'category', 'on_hiatus': 'category'},
+    'Coa_Surveys': {'Program Activity ID': 'Int64', 'Unique PEARS ID of Response': 'Int64',
+                    'staff_email': email_dtype,
+                    'For which Quarter are you completing this survey?&nbsp;': 'category'},
+    'SNAP_Ed_Staff': {'E-MAIL': email_dtype},
+    'HEAT_Staff': {'E-MAIL': email_dtype},
+    'State_Staff': {'E-MAIL': email_dtype},
+    'CPHP_Staff': {'Email Address': email_dtype}
+}
+# Sheets using at least this many MB before conversion have their change in memory printed,
+# every sheet's change is written to the run log
+schema_report_min_mb = setting('schema_report_min_mb', 1.0)
+
+
+# Function to convert a column of IDs to nullable integers
+# Values that aren't whole numbers, or are too large to be stored exactly, become missing
+# series: series of IDs read as numbers or text
+def to_int_ids(series):
+    ids = pd.to_numeric(series, errors='coerce')
+    return ids.where((ids % 1 == 0) & (ids.abs() < 2 ** 53)).astype('Int64')
+
+
+# Function to convert the columns of a dataframe to the types in a schema
+# Returns the converted dataframe and a dict of its memory usage in MB before and after conversion
+# df: dataframe of an input sheet
+# schema: dict of column labels to types, 'Int64' columns are converted with to_int_ids
+def apply_schema(df, schema):
+    memory_before = df.memory_usage(deep=True).sum() / (1024 * 1024)
+    df = df.copy()
+    for col, dtype in schema.items():
+        if col not in df:
+            continue
+        if dtype == 'Int64':
+            df[col] = to_int_ids(df[col])
+        else:
+            df[col] = df[col].astype(dtype)
+    memory_after = df.memory_usage(deep=True).sum() / (1024 * 1024)
+    return df, {'memory_before_mb': memory_before, 'memory_after_mb': memory_after,
+                'memory_saved_mb': memory_before - memory_after,
+                'memory_saved': 1 - memory_after / memory_before if memory_before else 0.0}
+
+
+# Stages of the pipeline, keyed by name
+# Each stage is a function that takes the Pipeline and returns the stage's result
+stages = {}
+
+
+# Decorator to register a function as a stage of the pipeline
+# name: string for the stage's name
+# requires: list of names of the stages whose results the function gets with pipeline.get (default: None)
+# sources: list of input_sources names of the sheets the function reads with pipeline.sheet (default: None)
+# stored: whether the result, a dataframe, is kept in cache_path and reused while the workbooks of the sheets it
+#   depends on are unchanged, without evaluating the stages it requires (default: False)
+def stage(name, requires=None, sources=None, stored=False):
+    def register(func):
+        stages[name] = {'func': func, 'requires': requires or [], 'sources': sources or [], 'stored': stored}
+        return func
+
+    return register
+
+
+# Function to count the rows of a stage's inputs or result for the run log
+# Dicts and lists are counted by the dataframes they contain, None is returned if there are none
+# result: dataframe, or dict or list of results
+def count_rows(result):
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    if isinstance(result, (dict, list)):
+        counts = [count_rows(value) for value in (result.values() if isinstance(result, dict) else result)]
+        counts = [count for count in counts if count is not None]
+        return sum(counts) if counts else None
+    return None
+
+
+# Class for lazily evaluating the pipeline's stages for one export directory and fiscal quarter
+# A stage is only evaluated when its result, or the result of a stage that requires it, is asked for
+# Results are kept, so each stage runs at most once
+# The sheets needed by the requested stages are read together in parallel before any of them run
+# export_dir: string for the directory of reformatted PEARS module exports (default: pears_export_path)
+# inputs_dir: string for the directory of the staff list, Update Notifications and unit counties workbooks
+#   (default: inputs_path)
+# fq: string for the fiscal quarter to clean, e.g. 'Q2' (default: fiscal_quarter, or the most recently completed
+#   quarter)
+# out_dir: string for the directory reports are written to (default: out_path)
+# run_name: string for the filename prefix of the run logs (default: run_id)
+# fy: int for the fiscal year of fq recorded in the corrections history (default: fiscal_year, or the fiscal year
+#   of the most recent fq)
+# results: dict of stage names to results that are already known, e.g. shared by run_batch (default: None)
+class Pipeline:
+    def __init__(self, export_dir=None, inputs_dir=None, fq=None, out_dir=None, run_name=None, fy=None,
+                 results=None):
+        self.export_dir = pears_export_path if export_dir is None else export_dir
+        self.inputs_dir = inputs_path if inputs_dir is None else inputs_dir
+        self.out_dir = out_path if out_dir is None else out_dir
+        self.run_name = run_id if run_name is None else run_name
+        self.fq, self.survey_fq = quarter_labels(fiscal_quarter if fq is None else fq)
+        self.fy = int((fiscal_year if fy is None else fy) or quarter_fiscal_year(self.fq))
+        self.sources = input_sources(self.export_dir, self.inputs_dir, self.fq)
+        self.sheets = {}
+        self.memory_savings = {}
+        self.results = dict(results or {})
+        self.timer = StageTimer(self.run_name)
+
+    # Returns the names of the stages that must be evaluated to get the named stages, each after the stages it requires
+    # names: list of stage names
+    def plan(self, names):
+        order = []
+
+        def visit(name):
+            if name in self.results or name in order or self.restore(name):
+                return
+            if name not in stages:
+                raise KeyError('Unknown stage: ' + name)
+            for required in stages[name]['requires']:
+                visit(required)
+            order.append(name)
+
+        for name in names:
+            visit(name)
+        return order
+
+    # Read the named sheets that haven't been read yet and convert them to their input_schemas types
+    # The change in memory from converting each sheet is written to the run log's _schema.csv,
+    # and printed for sheets of at least schema_report_min_mb
+    # names: list of input_sources names
+    def load(self, names):
+        missing = [name for name in dict.fromkeys(names) if name not in self.sheets]
+        if not missing:
+            return
+        self.timer.start('ingest')
+        for name, df in load_inputs({name: self.sources[name] for name in missing}).items():
+            if name in input_schemas:
+                df, self.memory_savings[name] = apply_schema(df, input_schemas[name])
+                memory = self.memory_savings[name]
+                if memory['memory_before_mb'] >= schema_report_min_mb:
+                    print(name + ': ' + format(memory['memory_before_mb'], '.1f') + ' MB -> ' +
+                          format(memory['memory_after_mb'], '.1f') + ' MB (' + format(-memory['memory_saved'], '+.0%') +
+                          ')')
+            self.sheets[name] = df
+        self.timer.stop(rows_out=count_rows([self.sheets[name] for name in missing]))
+        if self.memory_savings:
+            os.makedirs(run_log_path, exist_ok=True)
+            pd.DataFrame.from_dict(self.memory_savings, orient='index').rename_axis('sheet').to_csv(
+                run_log_path + '/' + self.run_name + '_schema.csv')
+
+    # Get a sheet, reading it if it hasn't been read yet
+    # Sheets are shared between stages and must not be modified
+    # name: string for the input_sources name
+    def sheet(self, name):
+        self.load([name])
+        return self.sheets[name]
+
+    # Get the result of a stage, evaluating it and the stages it requires if they haven't been evaluated yet
+    # Results are shared between stages and must not be modified
+    # name: string for the stage's name
+    def get(self, name):
+        if name not in self.results:
+            order = self.plan([name])
+            self.load([source for stage_name in order for source in stages[stage_name]['sources']])
+            for stage_name in order:
+                inputs = [self.results[required] for required in stages[stage_name]['requires']] + [
+                    self.sheets[source] for source in stages[stage_name]['sources']]
+                self.timer.start(stage_name, rows_in=count_rows(inputs))
+                self.results[stage_name] = stages[stage_name]['func'](self)
+                self.timer.stop(rows_out=count_rows(self.results[stage_name]))
+                if stages[stage_name]['stored']:
+                    self.store(stage_name)
+        return self.results[name]
+
+    # Get the results of several stages, reading the sheets needed by all of them together before any of them run
+    # Returns a list of the results, in the order of names
+    # names: list of stage names
+    def get_all(self, names):
+        self.load([source for stage_name in self.plan(names) for source in stages[stage_name]['sources']])
+        return [self.get(name) for name in names]
+
+    # Returns the input_sources names of the sheets a stage reads itself or through the stages it requires
+    # name: string for the stage's name
+    def stage_sources(self, name):
+        sources = set(stages[name]['sources'])
+        for required in stages[name]['requires']:
+            sources |= self.stage_sources(required)
+        return sources
+
+    # Returns the filepath a stored stage's result is kept in
+    # Files are keyed on the stage, export directory and quarter, and on the hashes of the workbooks the stage
+    # depends on, this script and the PEARS_ settings, so changing any of them stores a new result
+    # name: string for the stage's name
+    def stored_file(self, name):
+        stage_key = '|'.join([name, os.path.realpath(self.export_dir), os.path.realpath(self.inputs_dir), self.fq])
+        stage_key = hashlib.sha256(stage_key.encode()).hexdigest()[:16]
+        inputs_key = [file_hash(__file__)] + [
+            repr(self.sources[source]) + file_hash(self.sources[source]['file_path'])
+            for source in sorted(self.stage_sources(name))] + sorted(
+            key + '=' + value for key, value in os.environ.items() if key.startswith('PEARS_'))
+        inputs_key = hashlib.sha256('|'.join(inputs_key).encode()).hexdigest()[:16]
+        return cache_path + '/' + name + '_' + stage_key + '_' + inputs_key + '.parquet'
+
+    # Get a stored stage's result from cache_path if the workbooks it depends on are unchanged
+    # Returns True if the result was restored
+    # name: string for the stage's name
+    def restore(self, name):
+        if not stages[name]['stored'] or not store_stage_results or pyarrow is None:
+            return False
+        try:
+            self.results[name] = pd.read_parquet(self.stored_file(name))
+        except FileNotFoundError:
+            # Also raised for a missing workbook, which is reported by the stage that reads it
+            return False
+        return True
+
+    # Keep a stored stage's result in cache_path for later runs
+    # name: string for the stage's name
+    def store(self, name):
+        if not store_stage_results or pyarrow is None:
+            return
+        stored_file = self.stored_file(name)
+        os.makedirs(cache_path, exist_ok=True)
+        # Each process writes its own temporary file, which replaces the stored file in one step
+        temp_file = stored_file + '.' + str(os.getpid()) + '.tmp'
+        self.results[name].to_parquet(temp_file)
+        os.replace(temp_file, stored_file)
+        # Results stored for earlier versions of the workbooks are removed, unless another job stored them later
+        written = os.stat(stored_file).st_mtime_ns
+        for stale_file in glob.glob(stored_file.rsplit('_', 1)[0] + '_*.parquet'):
+            try:
+                if stale_file != stored_file and os.stat(stale_file).st_mtime_ns < written:
+                    os.remove(stale_file)
+            except FileNotFoundError:
+                pass
+
+    # Drop sheets or stage results, and the results of every stage that depends on them
+    # Dropped sheets are read again and dropped stages evaluated again the next time they're asked for
+    # Returns the names of the stages whose results were dropped
+    # names: list of input_sources names, e.g. of sheets whose workbooks changed, or stage names
+    def invalidate(self, names):
+        for name in names:
+            self.sheets.pop(name, None)
+            self.memory_savings.pop(name, None)
+        stale = {name for name in names if name in stages}
+        changed = True
+        while changed:
+            changed = False
+            for stage_name, registered in stages.items():
+                if stage_name not in stale and (set(registered['sources']) & set(names) or
+                                                set(registered['requires']) & stale):
+                    stale.add(stage_name)
+                    changed = True
+        dropped = [stage_name for stage_name in self.results if stage_name in stale]
+        for stage_name in dropped:
+            del self.results[stage_name]
+        return dropped
 
-# Import Update Notifications, used for the Corrections Report
-Update_Notes = pd.read_excel(ROOT_DIR + "/example_inputs/Update Notifications.xlsx",
-                             sheet_name='Quarterly Data Cleaning').drop(columns='Tab')
 
-# Import and consolidate staff lists
 # Data cleaning is only conducted on records related to SNAP-Ed and Family Consumer Science programming
+@stage('coalition_data', sources=['Coa_Data'])
+def load_coalitions(p):
+    Coa_Data = p.sheet('Coa_Data')
+    return Coa_Data.loc[Coa_Data['program_area'].isin(['SNAP-Ed', 'Family Consumer Science'])]
+
+
+# First meeting of each coalition
+# Not used for data cleaning, so the Meetings sheet is only read if this stage is asked for
+@stage('coalition_meetings', requires=['coalition_data'], sources=['Coa_Meetings'])
+def load_meetings(p):
+    Coa_Meetings = p.sheet('Coa_Meetings').copy()
+    Coa_Meetings['coalition_id'] = to_int_ids(Coa_Meetings['coalition_id'])
+    Coa_Meetings['start_date'] = pd.to_datetime(Coa_Meetings['start_date'])
+    Coa_Meetings = Coa_Meetings.sort_values(by='start_date').drop_duplicates(subset='coalition_id', keep='first')
+    return pd.merge(p.get('coalition_data'), Coa_Meetings[['coalition_id', 'start_date']], how='left',
+                    on='coalition_id')
+
+
+# Function to clean coalition IDs from survey responses
+# df: dataframe of survey responses with renamed columns
+def clean_surveys(df):
+    df = df.copy()
+    # Remove all characters besides digits from coalition_id
+    df['coalition_id'] = df['coalition_id'].astype(str)
+    df.loc[~df['coalition_id'].str.isnumeric(), 'coalition_id'] = df['coalition_id'].str.extract(
+        '(\d+)', expand=False)
+    # Match the type of the Coalitions export's coalition_id
+    df['coalition_id'] = to_int_ids(df['coalition_id'])
+    return df
+
+
+@stage('surveys', sources=['Coa_Surveys'])
+def load_surveys(p):
+    # filter Responses By Survey by Completed == ---- to export all responses
+    # Only this quarter's responses without TEST coalitions are read (see input_sources)
+    Coa_Surveys = p.sheet('Coa_Surveys').rename(columns=survey_columns)
+    return clean_surveys(Coa_Surveys)
+    # Auto export?
+    # Responses by Survey filters: Name == Coalition Survey & Survey Status == Active
+    # Export filters: Reporting Period == Extension 2021 & Type of Export == Individual Responses
+
+
+# Import Update Notifications, used for the Corrections Report
+@stage('update_notes', sources=['Update_Notes'])
+def load_update_notes(p):
+    return p.sheet('Update_Notes').drop(columns='Tab')
+
 
-FY22_INEP_Staff = pd.ExcelFile(ROOT_DIR + "/example_inputs/FY22_INEP_Staff_List.xlsx")
-SNAP_Ed_Staff = pd.read_excel(FY22_INEP_Staff, sheet_name='SNAP-Ed Staff List', header=0)
-HEAT_Staff = pd.read_excel(FY22_INEP_Staff, sheet_name='HEAT Project Staff', header=0)
-State_Staff = pd.read_excel(FY22_INEP_Staff, sheet_name='FCS State Office', header=0)
-staff_cols = ['NAME', 'E-MAIL']
-staff_dfs = [SNAP_Ed_Staff[staff_cols], HEAT_Staff[staff_cols], State_Staff[staff_cols]]
-INEP_Staff = pd.concat(staff_dfs, ignore_index=True).rename(columns={'E-MAIL': 'email'})
-INEP_Staff = INEP_Staff.loc[~INEP_Staff.isnull().any(1)]
-INEP_Staff['NAME'] = INEP_Staff['NAME'].str.split(pat=', ')
-INEP_Staff['first_name'] = INEP_Staff['NAME'].str[1]
-INEP_Staff['last_name'] = INEP_Staff['NAME'].str[0]
-INEP_Staff['full_name'] = INEP_Staff['first_name'].map(str) + ' ' + INEP_Staff['last_name'].map(str)
-CPHP_Staff = pd.read_excel(FY22_INEP_Staff, sheet_name='CPHP Staff List', header=0).rename(
-    columns={'Last Name': 'last_name',
-             'First Name': 'first_name',
-             'Email Address': 'email'})
-CPHP_Staff['full_name'] = CPHP_Staff['first_name'].map(str) + ' ' + CPHP_Staff['last_name'].map(str)
-staff = INEP_Staff.drop(columns='NAME').append(
-    CPHP_Staff.loc[~CPHP_Staff['email'].isnull(), ['email', 'first_name', 'last_name', 'full_name']],
-    ignore_index=True).drop_duplicates()
+# Import and consolidate staff lists
+@stage('staff', sources=['SNAP_Ed_Staff', 'HEAT_Staff', 'State_Staff', 'CPHP_Staff'])
+def consolidate_staff(p):
+    staff_cols = ['NAME', 'E-MAIL']
+    staff_dfs = [p.sheet('SNAP_Ed_Staff')[staff_cols], p.sheet('HEAT_Staff')[staff_cols],
+                 p.sheet('State_Staff')[staff_cols]]
+    INEP_Staff = pd.concat(staff_dfs, ignore_index=True).rename(columns={'E-MAIL': 'email'})
+    INEP_Staff = INEP_Staff.loc[~INEP_Staff.isnull().any(1)]
+    INEP_Staff['NAME'] = INEP_Staff['NAME'].str.split(pat=', ')
+    INEP_Staff['first_name'] = INEP_Staff['NAME'].str[1]
+    INEP_Staff['last_name'] = INEP_Staff['NAME'].str[0]
+    INEP_Staff['full_name'] = INEP_Staff['first_name'].map(str) + ' ' + INEP_Staff['last_name'].map(str)
+    CPHP_Staff = p.sheet('CPHP_Staff').rename(
+        columns={'Last Name': 'last_name',
+                 'First Name': 'first_name',
+                 'Email Address': 'email'})
+    CPHP_Staff['full_name'] = CPHP_Staff['first_name'].map(str) + ' ' + CPHP_Staff['last_name'].map(str)
+    return INEP_Staff.drop(columns='NAME').append(
+        CPHP_Staff.loc[~CPHP_Staff['email'].isnull(), ['email', 'first_name', 'last_name', 'full_name']],
+        ignore_index=True).drop_duplicates()
 
 
 # function for reordering comma-separated name
@@ -107,41 +765,355 @@ def reorder_name(df, name_field, reordered_name_field, drop_substr_fields=False)
 
 
 # Create lookup table for unit to regional educators
-re_lookup = pd.read_excel(FY22_INEP_Staff, sheet_name="RE's and CD's")[['UNIT #', 'REGIONAL EDUCATOR', 'NETID/E-MAIL']]
-re_lookup['REGIONAL EDUCATOR'] = re_lookup['REGIONAL EDUCATOR'].str.replace(', Interim', '')
-re_lookup = re_lookup.drop_duplicates()
-re_lookup = reorder_name(re_lookup, 'REGIONAL EDUCATOR', 'REGIONAL EDUCATOR', drop_substr_fields=True)
-re_lookup['UNIT #'] = re_lookup['UNIT #'].astype(str)
+@stage('re_lookup', requires=['unit_resolver'], sources=['RE_Staff'])
+def load_regional_educators(p):
+    re_lookup = p.sheet('RE_Staff')[['UNIT #', 'REGIONAL EDUCATOR', 'NETID/E-MAIL']].copy()
+    re_lookup['REGIONAL EDUCATOR'] = re_lookup['REGIONAL EDUCATOR'].str.replace(', Interim', '')
+    re_lookup = re_lookup.drop_duplicates()
+    re_lookup = reorder_name(re_lookup, 'REGIONAL EDUCATOR', 'REGIONAL EDUCATOR', drop_substr_fields=True)
+    re_lookup['UNIT #'] = p.get('unit_resolver').resolve(re_lookup['UNIT #'], 'Regional educator unit')
+    return re_lookup
+
+
+# Class for constant-time lookups of staff names and regional educator contacts
+# Duplicate and missing keys are reported when the directory is built instead of failing mid-send
+# staff_df: dataframe of consolidated staff with email, first_name and full_name columns
+# state_staff_df: dataframe of FCS State Office staff with an E-MAIL column
+# re_df: dataframe of units to regional educators with UNIT #, REGIONAL EDUCATOR and NETID/E-MAIL columns
+class StaffDirectory:
+    def __init__(self, staff_df, state_staff_df, re_df):
+        self.problems = []
+        self.staff = self.index(staff_df, 'email', ['first_name', 'full_name'], 'staff')
+        self.state_emails = set(state_staff_df['E-MAIL'].dropna())
+        self.regional_educators = self.index(re_df, 'UNIT #', ['REGIONAL EDUCATOR', 'NETID/E-MAIL'],
+                                             'regional educator')
+        for problem in self.problems:
+            print(problem)
+
+    # Build a dict of key to a tuple of value_cols, recording missing and duplicate keys in self.problems
+    # The first entry is kept for duplicate keys
+    # df: dataframe to index
+    # key: column label of the key field
+    # value_cols: list of column labels of the value fields
+    # label: string describing the records for problem messages
+    def index(self, df, key, value_cols, label):
+        missing = df[key].isnull() | df[key].isin(['', 'nan'])
+        if missing.any():
+            self.problems.append(str(missing.sum()) + ' ' + label + ' record(s) missing ' + key + ' were skipped.')
+        df = df.loc[~missing].drop_duplicates(subset=[key] + value_cols)
+        incomplete = df.loc[df[value_cols].isnull().any(axis=1), key]
+        if not incomplete.empty:
+            self.problems.append(label.capitalize() + ' record(s) missing ' + ' or '.join(value_cols) + ': ' +
+                                 ', '.join(incomplete.astype(str)))
+        duplicates = df.loc[df[key].duplicated(), key].unique()
+        if len(duplicates):
+            self.problems.append('Duplicate ' + label + ' ' + key + ' (first entry used): ' +
+                                 ', '.join(map(str, duplicates)))
+        df = df.drop_duplicates(subset=key)
+        return dict(zip(df[key], zip(*[df[col] for col in value_cols])))
+
+    def __contains__(self, email):
+        return email in self.staff
+
+    def first_name(self, email):
+        return self.staff[email][0]
+
+    def full_name(self, email):
+        return self.staff[email][1]
+
+    def is_state_staff(self, email):
+        return email in self.state_emails
+
+    # Returns a tuple of the regional educator's name and email for a unit, or None if the unit has none
+    def regional_educator(self, unit):
+        return self.regional_educators.get(unit)
+
+
+@stage('staff_directory', requires=['staff', 're_lookup'], sources=['State_Staff'])
+def build_staff_directory(p):
+    return StaffDirectory(p.get('staff'), p.sheet('State_Staff'), p.get('re_lookup'))
+
 
 # Import lookup table for counties to unit
-unit_counties = pd.read_excel(ROOT_DIR + "/example_inputs/Illinois Extension Unit Counties.xlsx")
-unit_counties['Unit #'] = unit_counties['Unit #'].astype(str)
+@stage('unit_counties', sources=['unit_counties'])
+def load_unit_counties(p):
+    unit_counties = p.sheet('unit_counties').copy()
+    unit_counties['Unit #'] = unit_counties['Unit #'].astype(str)
+    return unit_counties
+
+
+# County, district and unit suffixes and prefixes removed from unit fields before they're looked up
+unit_affixes = re.compile(r'\s*\((?:county|district)\)|\bunit\s+', re.IGNORECASE)
+
+
+# Function to normalize a county, district or unit name for lookups: affixes removed, lowercase, single spaces
+# value: county, district or unit name, e.g. 'Cook (County)' or 'Unit 5'
+def unit_key(value):
+    return ' '.join(unit_affixes.sub(' ', str(value)).lower().split())
+
+
+# Class for resolving county, district and unit names to unit numbers
+# The lookup dict is compiled once, and columns are resolved by looking up each distinct value once
+# Values that are already unit numbers are kept, and the first unit is used for counties listed more than once
+# unit_counties: dataframe of counties to unit numbers with County and Unit # columns
+class UnitResolver:
+    def __init__(self, unit_counties):
+        units = unit_counties.dropna(subset=['County', 'Unit #'])
+        self.lookup = {unit_key(unit): unit for unit in units['Unit #']}
+        for county, unit in zip(units['County'], units['Unit #']):
+            self.lookup.setdefault(unit_key(county), unit)
+
+    # Returns a series of unit numbers as strings
+    # Values that can't be resolved keep their name with affixes removed, and missing values stay missing
+    # values: series of county, district or unit names
+    # label: string describing the values, if given unresolved values are reported (default: None)
+    def resolve(self, values, label=None):
+        uniques = pd.Series(values.dropna().unique())
+        names = uniques.astype(str)
+        resolved = names.map(lambda name: self.lookup.get(unit_key(name)))
+        unresolved = resolved.isnull()
+        if label is not None and unresolved.any():
+            print(str(values.isin(uniques[unresolved]).sum()) + ' ' + label + ' value(s) not found in the unit '
+                  'counties lookup table: ' + ', '.join(names[unresolved].sort_values()))
+        resolved[unresolved] = names[unresolved].str.replace(unit_affixes, '', regex=True).str.strip()
+        # Categorical columns are resolved by mapping their categories
+        return values.map(dict(zip(uniques, resolved)))
+
+
+@stage('unit_resolver', requires=['unit_counties'])
+def build_unit_resolver(p):
+    return UnitResolver(p.get('unit_counties'))
+
 
 # Coalition Surveys Data Cleaning
 
 # Coalitions
 
-Coa_Data['coalition_unit'] = Coa_Data['coalition_unit'].str.replace('|'.join([' \(County\)', ' \(District\)', 'Unit ']),
-                                                                    '', regex=True)
 
-Coa_Data = pd.merge(Coa_Data, unit_counties, how='left', left_on='coalition_unit', right_on='County')
-Coa_Data.loc[(~Coa_Data['coalition_unit'].isin(unit_counties['Unit #'])) & (
-    Coa_Data['coalition_unit'].isin(unit_counties['County'])), 'coalition_unit'] = Coa_Data['Unit #']
+# Function to clean the Coalitions export: convert counties to unit numbers and drop TEST coalitions
+# df: dataframe of Coalition Data
+# unit_resolver: UnitResolver of counties to unit numbers
+def clean_coalitions(df, unit_resolver):
+    # Rows are renumbered as they were when units were merged in, since the row numbers are shown in emails
+    df = df.reset_index(drop=True)
+    df = df.loc[~df['coalition_name'].str.contains('(?i)TEST', regex=True),
+                ['coalition_id', 'coalition_name', 'reported_by_email', 'coalition_unit', 'program_area',
+                 'relationship_depth', 'created', 'modified', 'on_hiatus']].rename(columns={'coalition_unit': 'unit'})
+    df['unit'] = unit_resolver.resolve(df['unit'], 'Coalition unit').astype('category')
+    return df
+
 
-Coa_Data = Coa_Data.loc[~Coa_Data['coalition_name'].str.contains('(?i)TEST', regex=True),
-                        ['coalition_id', 'coalition_name', 'reported_by_email', 'coalition_unit', 'program_area',
-                         'relationship_depth', 'created', 'modified', 'on_hiatus']].rename(
-    columns={'coalition_unit': 'unit'})
+@stage('coalitions', requires=['coalition_data', 'unit_resolver'])
+def merge_coalition_units(p):
+    return clean_coalitions(p.get('coalition_data'), p.get('unit_resolver'))
+
+
+# Coalitions in the Coordination, Coalition or Collaboration stage that have no survey this quarter
+@stage('coalition_validation', requires=['coalitions', 'surveys'], stored=True)
+def validate_coalitions(p):
+    Coa_Data = p.get('coalitions').copy()
+    Coa_Surveys = p.get('surveys')
+    Coa_Data['UPDATES'] = np.nan
+    Coa_Data.loc[(Coa_Data['relationship_depth'].isin(['Coalition', 'Collaboration', 'Coordination']))
+                 & (~Coa_Data['coalition_id'].isin(Coa_Surveys['coalition_id']))
+                 & (Coa_Data['on_hiatus'] != 'Yes'),
+                 'UPDATES'] = 'Please submit a Coalition Survey for this Coalition.'
+
+    return Coa_Data.loc[(Coa_Data['UPDATES'].notnull())].drop(
+        columns=['program_area', 'created', 'modified']).rename(columns={'coalition_unit': 'unit'})
 
-Coa_Data['UPDATES'] = np.nan
-Coa_Data.loc[(Coa_Data['relationship_depth'].isin(['Coalition', 'Collaboration', 'Coordination']))
-             & (~Coa_Data['coalition_id'].isin(Coa_Surveys['coalition_id']))
-             & (Coa_Data['on_hiatus'] != 'Yes'),
-             'UPDATES'] = 'Please submit a Coalition Survey for this Coalition.'
 
-Coa_Corrections = Coa_Data.loc[(Coa_Data['UPDATES'].notnull())].drop(
-    columns=['program_area', 'created', 'modified']).rename(columns={'coalition_unit': 'unit'}).fillna('')
 # Send to corrections report and email
+# Typed columns are converted to object so missing values can be blanked
+@stage('coalition_corrections', requires=['coalition_validation'])
+def format_coalition_corrections(p):
+    return p.get('coalition_validation').astype(object).fillna('')
+
+
+# Settings for suggesting the intended coalition of survey responses with unmatched coalition IDs
+# suggestion_min_confidence: minimum confidence, from 0 to 1, for a suggestion to be reported
+# suggestion_candidates: number of coalitions sharing the most name trigrams that are scored for each response
+# index_max_postings: trigrams found in more coalition names than this (e.g. 'coa') are too common to find candidates
+suggestion_min_confidence = setting('suggestion_min_confidence', 0.7)
+suggestion_candidates = setting('suggestion_candidates', 20)
+index_max_postings = setting('index_max_postings', 1000)
+
+
+# Function to normalize a coalition name for comparison: lowercase letters and digits separated by single spaces
+# name: string for the coalition name
+def normalize_name(name):
+    return ' '.join(''.join(c if c.isalnum() else ' ' for c in str(name).lower()).split())
+
+
+# Function to get the set of three-character substrings of a normalized name, padded so short names have trigrams
+# name: string for the normalized name
+def trigrams(name):
+    name = ' ' + name + ' '
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+
+# Function to calculate the edit distance between two strings
+# a, b: strings to compare
+def edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+# Class for suggesting the coalition a survey response with an unmatched coalition ID was meant for
+# Coalitions are indexed by ID, by the trigrams of their normalized names and by owner email,
+# so each response is only scored against the coalitions that share the most uncommon trigrams with its
+# coalition name, or that are owned by the same staff member, instead of against every coalition
+# df: dataframe of cleaned coalitions with coalition_id, coalition_name and reported_by_email columns
+class CoalitionIndex:
+    def __init__(self, df):
+        self.ids = df['coalition_id'].tolist()
+        self.names = [normalize_name(name) for name in df['coalition_name']]
+        self.owners = df['reported_by_email'].tolist()
+        self.id_positions = {coalition_id: position for position, coalition_id in enumerate(self.ids)
+                             if not pd.isna(coalition_id)}
+        postings = {}
+        for position, name in enumerate(self.names):
+            for trigram in trigrams(name):
+                postings.setdefault(trigram, []).append(position)
+        self.postings = {trigram: np.array(positions, dtype=np.int32) for trigram, positions in postings.items()}
+        self.owner_positions = {}
+        for position, owner in enumerate(self.owners):
+            if not pd.isna(owner):
+                self.owner_positions.setdefault(owner, []).append(position)
+
+    def __contains__(self, coalition_id):
+        return coalition_id in self.id_positions
+
+    # Save the index to a NumPy .npz file
+    # Unlike a pickle, the file only holds arrays, so reading it can't run code
+    # file_path: string for the file's path
+    def save(self, file_path):
+        trigram_keys = list(self.postings)
+        offsets = np.cumsum([0] + [len(self.postings[trigram]) for trigram in trigram_keys])
+        with open(file_path, 'wb') as f:
+            np.savez(f,
+                     ids=np.array([0 if pd.isna(coalition_id) else coalition_id for coalition_id in self.ids],
+                                  dtype=np.int64),
+                     ids_missing=np.array([pd.isna(coalition_id) for coalition_id in self.ids], dtype=bool),
+                     names=np.array(self.names, dtype=str),
+                     owners=np.array(['' if pd.isna(owner) else owner for owner in self.owners], dtype=str),
+                     owners_missing=np.array([pd.isna(owner) for owner in self.owners], dtype=bool),
+                     trigrams=np.array(trigram_keys, dtype=str),
+                     offsets=offsets.astype(np.int64),
+                     positions=np.concatenate([self.postings[trigram] for trigram in trigram_keys] or
+                                              [np.array([], dtype=np.int32)]))
+
+    # Returns a CoalitionIndex read from a file written by save
+    # file_path: string for the file's path
+    @classmethod
+    def read(cls, file_path):
+        with np.load(file_path, allow_pickle=False) as arrays:
+            index = cls.__new__(cls)
+            index.ids = [None if missing else coalition_id for coalition_id, missing in
+                         zip(arrays['ids'].tolist(), arrays['ids_missing'].tolist())]
+            index.names = arrays['names'].tolist()
+            index.owners = [None if missing else owner for owner, missing in
+                            zip(arrays['owners'].tolist(), arrays['owners_missing'].tolist())]
+            offsets, positions = arrays['offsets'], arrays['positions']
+            index.postings = {trigram: positions[offsets[i]:offsets[i + 1]]
+                              for i, trigram in enumerate(arrays['trigrams'].tolist())}
+        index.id_positions = {coalition_id: position for position, coalition_id in enumerate(index.ids)
+                              if coalition_id is not None}
+        index.owner_positions = {}
+        for position, owner in enumerate(index.owners):
+            if owner is not None:
+                index.owner_positions.setdefault(owner, []).append(position)
+        return index
+
+    # Score how likely a coalition is the one a response meant by its name and owner, from 0 to 0.9
+    # Name trigram similarity carries most of the weight, whether the owner submitted the response breaks ties
+    # position: int for the coalition's position in the index
+    # name_trigrams: set of trigrams of the response's normalized coalition name
+    # email: string for the email of the staff member who submitted the response
+    def name_score(self, position, name_trigrams, email):
+        candidate_trigrams = trigrams(self.names[position])
+        shared = len(name_trigrams & candidate_trigrams)
+        name_similarity = shared / len(name_trigrams | candidate_trigrams) if name_trigrams else 0.0
+        owner_match = 1.0 if self.owners[position] == email else 0.0
+        return 0.75 * name_similarity + 0.15 * owner_match
+
+    # Score how close a response's coalition ID is to a coalition's (e.g. a mistyped digit), from 0 to 0.1
+    # position: int for the coalition's position in the index
+    # coalition_id: int for the response's coalition ID, or missing
+    def id_score(self, position, coalition_id):
+        if pd.isna(coalition_id) or pd.isna(self.ids[position]):
+            return 0.0
+        a, b = str(coalition_id), str(self.ids[position])
+        return 0.1 * (1 - edit_distance(a, b) / max(len(a), len(b)))
+
+    # Returns a tuple of the suggested coalition ID and the confidence of the suggestion, from 0 to 1,
+    # or (None, None) if no coalition reaches suggestion_min_confidence
+    # coalition_id: int for the response's coalition ID, or missing
+    # coalition_name: string for the response's coalition name
+    # email: string for the email of the staff member who submitted the response
+    def suggest(self, coalition_id, coalition_name, email):
+        name_trigrams = trigrams(normalize_name(coalition_name)) if not pd.isna(coalition_name) else set()
+        hits = [self.postings[trigram] for trigram in name_trigrams
+                if trigram in self.postings and len(self.postings[trigram]) <= index_max_postings]
+        if hits:
+            positions, counts = np.unique(np.concatenate(hits), return_counts=True)
+            candidates = positions[np.argsort(-counts, kind='stable')[:suggestion_candidates]].tolist()
+        else:
+            # Names made only of common trigrams are compared with the coalitions the staff member owns
+            candidates = self.owner_positions.get(email, [])
+
+        # The ID score is only calculated for candidates whose name score is close enough to the best to win
+        name_scores = sorted(((self.name_score(position, name_trigrams, email), position) for position in candidates),
+                             key=lambda candidate: (-candidate[0], candidate[1]))
+        best_position, best_score = None, 0.0
+        for name_score, position in name_scores:
+            if name_score + 0.1 <= best_score or name_score + 0.1 < suggestion_min_confidence:
+                break
+            score = name_score + self.id_score(position, coalition_id)
+            if score > best_score:
+                best_position, best_score = position, score
+        if best_position is None or best_score < suggestion_min_confidence:
+            return None, None
+        return self.ids[best_position], round(best_score, 2)
+
+
+# Index of the cleaned coalitions, saved to cache_path so it's only rebuilt when the coalitions change
+# Batch jobs sharing cache_path may remove each other's index files, a removed file is rebuilt
+@stage('coalition_index', requires=['coalitions'])
+def load_coalition_index(p):
+    coalitions = p.get('coalitions')[['coalition_id', 'coalition_name', 'reported_by_email']]
+    if not use_sheet_cache:
+        return CoalitionIndex(coalitions)
+    index_key = hashlib.sha256(pd.util.hash_pandas_object(coalitions, index=False).values.tobytes()).hexdigest()
+    index_file = cache_path + '/coalition_index_' + index_key[:16] + '.npz'
+    try:
+        return CoalitionIndex.read(index_file)
+    except FileNotFoundError:
+        pass
+
+    index = CoalitionIndex(coalitions)
+    os.makedirs(cache_path, exist_ok=True)
+    # Each process writes its own temporary file, which replaces the index file in one step
+    temp_file = index_file + '.' + str(os.getpid()) + '.tmp'
+    index.save(temp_file)
+    os.replace(temp_file, index_file)
+    # Only index files older than this one are removed, so an index another job just wrote is kept
+    written = os.stat(index_file).st_mtime_ns
+    # Pickled indexes from earlier versions are removed too
+    stale_files = glob.glob(cache_path + '/coalition_index_*.npz') + glob.glob(cache_path + '/coalition_index_*.pkl')
+    for stale_file in stale_files:
+        try:
+            if stale_file != index_file and os.stat(stale_file).st_mtime_ns < written:
+                os.remove(stale_file)
+        except FileNotFoundError:
+            pass
+    return index
+
 
 # Coalition Surveys
 
@@ -151,67 +1123,306 @@ Coa_Corrections = Coa_Data.loc[(Coa_Data['UPDATES'].notnull())].drop(
 # Data Validation:
 # 'What is the coalition_id from the PEARS Coalition module that corresponds to this survey?' == numeric only
 
-Coa_Surveys['EVALUATION TAB UPDATES'] = np.nan
-Coa_Surveys.loc[~Coa_Surveys['coalition_id'].isin(Coa_Data['coalition_id']),
-                'EVALUATION TAB UPDATES'] = 'Coalition ID must be an exact match of the PEARS Coalition module that corresponds to this survey.'
-
-Coa_Survey_Corrections1 = Coa_Surveys.loc[Coa_Surveys['EVALUATION TAB UPDATES'].notnull()].set_index(
-    'program_id').fillna('')
-# Send to corrections report
-Coa_Survey_Corrections2 = Coa_Survey_Corrections1.drop(columns='response_id')
-# Send to corrections email
-
-
-# Corrections Report
-
+# Survey responses whose coalition ID doesn't match a coalition, with the coalition they most likely meant
+@stage('survey_validation', requires=['coalition_index', 'surveys'], stored=True)
+def validate_surveys(p):
+    index = p.get('coalition_index')
+    Coa_Surveys = p.get('surveys').copy()
+    Coa_Surveys['EVALUATION TAB UPDATES'] = np.nan
+    Coa_Surveys.loc[~Coa_Surveys['coalition_id'].isin(list(index.id_positions)),
+                    'EVALUATION TAB UPDATES'] = 'Coalition ID must be an exact match of the PEARS Coalition module that corresponds to this survey.'
 
-Coa_Sum = Coa_Corrections.count().to_frame(name="# of Entries").reset_index().rename(columns={'index': 'Update'})
-Coa_Sum = Coa_Sum.loc[Coa_Sum['Update'].str.contains('UPDATE')]
-# Coa_Total = {'Update' : 'Total', '# of Entries' : len(Coa_Corrections)}
-# Coa_Sum = Coa_Sum.append(Coa_Total, ignore_index=True)
-Coa_Sum['Module'] = 'Coalitions'
+    Coa_Survey_Corrections = Coa_Surveys.loc[Coa_Surveys['EVALUATION TAB UPDATES'].notnull()].copy()
+    suggestions = [index.suggest(*response) for response in Coa_Survey_Corrections[
+        ['coalition_id', 'coalition_name', 'reported_by_email']].itertuples(index=False, name=None)]
+    Coa_Survey_Corrections['SUGGESTED COALITION ID'] = pd.array([s[0] for s in suggestions], dtype='Int64')
+    Coa_Survey_Corrections['SUGGESTION CONFIDENCE'] = [s[1] for s in suggestions]
 
-Coa_Survey_Sum = Coa_Survey_Corrections1.count().to_frame(name="# of Entries").reset_index().rename(
-    columns={'index': 'Update'})
-Coa_Survey_Sum = Coa_Survey_Sum.loc[Coa_Survey_Sum['Update'].str.contains('UPDATE')]
-# Coa_Survey_Total = {'Update' : 'Total', '# of Entries' : len(Coa_Survey_Corrections1)}
-# Coa_Survey_Sum = Coa_Survey_Sum.append(Coa_Survey_Total, ignore_index=True)
-Coa_Survey_Sum['Module'] = 'Program Activities'
+    return Coa_Survey_Corrections
 
-Corrections_Sum = Coa_Sum.append(Coa_Survey_Sum, ignore_index=True)
-Corrections_Sum.insert(0, 'Module', Corrections_Sum.pop('Module'))
 
-Corrections_Sum = pd.merge(Corrections_Sum, Update_Notes, how='left', on=['Module', 'Update'])
+# Sent to the corrections report, and without response_id to the corrections emails
+@stage('survey_corrections', requires=['survey_validation'])
+def format_survey_corrections(p):
+    return p.get('survey_validation').set_index('program_id').astype(object).fillna('')
 
-out_path = ROOT_DIR + "/example_outputs"
-
-report_filename = 'Quarterly Coalition Survey Entry ' + fq + '.xlsx'
-report_file_path = out_path + '/' + report_filename
-
-report_dfs = {
-    'Corrections Summary': Corrections_Sum,
-    'Coalitions': Coa_Corrections,
-    'Coalition Surveys': Coa_Survey_Corrections1
-}
 
+# Corrections Report
 
-def write_report(file_path, dfs_dict):
-    writer = pd.ExcelWriter(file_path, engine='xlsxwriter')
-    for sheetname, df in dfs_dict.items():  # loop through `dict` of dataframes
-        df.to_excel(writer, sheet_name=sheetname, index=False, freeze_panes=(1, 0))  # send df to writer
-        worksheet = writer.sheets[sheetname]  # pull worksheet object
-        worksheet.autofilter(0, 0, 0, len(df.columns) - 1)
-        for idx, col in enumerate(df):  # loop through all columns
-            series = df[col]
-            max_len = max((
-                series.astype(str).map(len).max(),  # len of largest item
-                len(str(series.name))  # len of column name/header
-            )) + 1  # adding a little extra space
-            worksheet.set_column(idx, idx, max_len)  # set column width
-    writer.save()
 
+@stage('corrections_summary', requires=['coalition_corrections', 'survey_corrections', 'update_notes'])
+def summarize_corrections(p):
+    Coa_Sum = p.get('coalition_corrections').count().to_frame(name="# of Entries").reset_index().rename(
+        columns={'index': 'Update'})
+    Coa_Sum = Coa_Sum.loc[Coa_Sum['Update'].str.contains('UPDATE')]
+    # Coa_Total = {'Update' : 'Total', '# of Entries' : len(Coa_Corrections)}
+    # Coa_Sum = Coa_Sum.append(Coa_Total, ignore_index=True)
+    Coa_Sum['Module'] = 'Coalitions'
+
+    Coa_Survey_Sum = p.get('survey_corrections').count().to_frame(name="# of Entries").reset_index().rename(
+        columns={'index': 'Update'})
+    Coa_Survey_Sum = Coa_Survey_Sum.loc[Coa_Survey_Sum['Update'].str.contains('UPDATE')]
+    # Coa_Survey_Total = {'Update' : 'Total', '# of Entries' : len(Coa_Survey_Corrections1)}
+    # Coa_Survey_Sum = Coa_Survey_Sum.append(Coa_Survey_Total, ignore_index=True)
+    Coa_Survey_Sum['Module'] = 'Program Activities'
+
+    Corrections_Sum = Coa_Sum.append(Coa_Survey_Sum, ignore_index=True)
+    Corrections_Sum.insert(0, 'Module', Corrections_Sum.pop('Module'))
+
+    return pd.merge(Corrections_Sum, p.get('update_notes'), how='left', on=['Module', 'Update'])
+
+
+# Number of rows converted and written at once by write_report in constant memory mode
+report_chunk_size = 10000
+
+
+# Function to split a dataframe into chunks of rows
+# dfs: dataframe, or iterable of dataframe chunks that is passed through
+# chunk_size: int for the number of rows per chunk
+def iter_chunks(dfs, chunk_size):
+    if isinstance(dfs, pd.DataFrame):
+        return (dfs.iloc[start:start + chunk_size] for start in range(0, max(len(dfs), 1), chunk_size))
+    return iter(dfs)
+
+
+# Function to write a dict of dataframes to an Excel workbook with frozen, filtered headers and fitted column widths
+# file_path: string for the workbook's filepath
+# dfs_dict: dict of sheet names to dataframes
+#   In constant memory mode, values can also be iterables of dataframe chunks with the same columns
+# constant_memory: boolean, True to stream rows to disk with xlsxwriter's constant_memory mode
+#   and size columns one chunk at a time, False to write each dataframe with to_excel (default: True)
+def write_report(file_path, dfs_dict, constant_memory=True):
+    if not constant_memory:
+        writer = pd.ExcelWriter(file_path, engine='xlsxwriter')
+        for sheetname, df in dfs_dict.items():  # loop through `dict` of dataframes
+            df.to_excel(writer, sheet_name=sheetname, index=False, freeze_panes=(1, 0))  # send df to writer
+            worksheet = writer.sheets[sheetname]  # pull worksheet object
+            worksheet.autofilter(0, 0, 0, len(df.columns) - 1)
+            for idx, col in enumerate(df):  # loop through all columns
+                series = df[col]
+                max_len = max((
+                    series.astype(str).map(len).max(),  # len of largest item
+                    len(str(series.name))  # len of column name/header
+                )) + 1  # adding a little extra space
+                worksheet.set_column(idx, idx, max_len)  # set column width
+        writer.save()
+        return
+
+    # Date format and header format match pandas' to_excel output
+    workbook = xlsxwriter.Workbook(file_path, {'constant_memory': True,
+                                               'default_date_format': 'YYYY-MM-DD HH:MM:SS'})
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    for sheetname, dfs in dfs_dict.items():
+        worksheet = workbook.add_worksheet(sheetname)
+        worksheet.freeze_panes(1, 0)
+        widths = None
+        row = 1
+        for chunk in iter_chunks(dfs, report_chunk_size):
+            if widths is None:
+                # Rows must be written in order in constant memory mode, so write the header with the first chunk
+                worksheet.write_row(0, 0, [str(col) for col in chunk.columns], header_format)
+                widths = np.array([len(str(col)) for col in chunk.columns])
+            if chunk.empty:
+                continue
+            chunk_widths = [chunk[col].astype(str).str.len().max() for col in chunk]  # len of largest item in chunk
+            widths = np.maximum(widths, chunk_widths)
+            # Blank cells for missing values
+            for record in chunk.astype(object).where(chunk.notnull(), None).itertuples(index=False, name=None):
+                worksheet.write_row(row, 0, record)
+                row += 1
+        if widths is not None and len(widths):
+            worksheet.autofilter(0, 0, 0, len(widths) - 1)
+            for idx, width in enumerate(widths):
+                worksheet.set_column(idx, idx, width + 1)  # adding a little extra space
+    workbook.close()
+
+
+# Returns a dict of the report's file_path, filename and the dfs written to it
+@stage('corrections_report', requires=['corrections_summary', 'coalition_corrections', 'survey_corrections'])
+def build_corrections_report(p):
+    report_filename = 'Quarterly Coalition Survey Entry ' + p.fq + '.xlsx'
+    report_file_path = p.out_dir + '/' + report_filename
+
+    report_dfs = {
+        'Corrections Summary': p.get('corrections_summary'),
+        'Coalitions': p.get('coalition_corrections'),
+        'Coalition Surveys': p.get('survey_corrections')
+    }
+    write_report(report_file_path, report_dfs)
+    return {'file_path': report_file_path, 'filename': report_filename, 'dfs': report_dfs}
+
+
+# Corrections History
+
+# Each run's corrections and Corrections_Sum are appended to a SQLite database in /history,
+# so trends across quarters can be queried without reopening past corrections reports (see query_history.py)
+# Set record_history to False to skip recording
+record_history = setting('record_history', True)
+history_path = setting('history_path', ROOT_DIR + "/history/coalition_survey_history.db")
+
+# Columns of each history table that are indexed, besides run_id and quarter
+history_indexes = {'coalition_corrections': ['coalition_id', 'unit', 'reported_by_email'],
+                   'survey_corrections': ['coalition_id', 'reported_by_email'],
+                   'corrections_summary': []}
+
+
+# Function to open the history database, creating its runs table and latest_runs view if they don't exist
+# Returns a sqlite3 connection
+# Runs of the same export directory and quarter (e.g. monthly reruns) are all kept,
+# latest_runs only includes the most recent one
+# path: string for the database's filepath (default: None, history_path)
+def open_history(path=None):
+    path = history_path if path is None else path
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # Batch workers record their jobs at the same time, so wait for each other's writes
+    con = sqlite3.connect(path, timeout=60)
+    con.execute('CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, export_dir TEXT, fiscal_year INTEGER, '
+                'fq TEXT, quarter INTEGER, recorded TEXT)')
+    con.execute('CREATE INDEX IF NOT EXISTS runs_quarter ON runs (export_dir, quarter)')
+    con.execute('CREATE VIEW IF NOT EXISTS latest_runs AS SELECT * FROM runs WHERE rowid IN '
+                '(SELECT MAX(rowid) FROM runs GROUP BY export_dir, quarter)')
+    return con
+
+
+# Function to append a dataframe to a history table, creating the table and any columns it doesn't have yet
+# Column names are converted to lowercase words separated by underscores, e.g. 'EVALUATION TAB UPDATES'
+# con: sqlite3 connection to the history database
+# table: string for the table's name
+# df: dataframe to append, blank and missing values are stored as NULL
+def append_history(con, table, df):
+    df = df.rename(columns=lambda column: normalize_name(column).replace(' ', '_'))
+    columns = [row[1] for row in con.execute('PRAGMA table_info(' + table + ')')]
+    if not columns:
+        con.execute('CREATE TABLE ' + table + ' (' + ', '.join('"' + column + '"' for column in df.columns) + ')')
+    for column in df.columns:
+        if columns and column not in columns:
+            con.execute('ALTER TABLE ' + table + ' ADD COLUMN "' + column + '"')
+    df = df.astype(object)
+    df = df.where(df.notnull() & (df != ''), None)
+    # sqlite3 only stores Python numbers, so numpy scalars are converted with item()
+    records = [tuple(value.item() if isinstance(value, np.generic) else value for value in record)
+               for record in df.itertuples(index=False, name=None)]
+    con.executemany('INSERT INTO ' + table + ' (' + ', '.join('"' + column + '"' for column in df.columns) +
+                    ') VALUES (' + ', '.join('?' * len(df.columns)) + ')', records)
+
+
+# Appends the run's corrections and Corrections_Sum to the history database, replacing any earlier copy of this run
+# Returns a dict of the number of rows recorded in each history table
+@stage('history', requires=['corrections_summary', 'coalition_corrections', 'survey_corrections'])
+def record_corrections_history(p):
+    if not record_history:
+        return {}
+    history_dfs = {'coalition_corrections': p.get('coalition_corrections'),
+                   'survey_corrections': p.get('survey_corrections').reset_index(),
+                   'corrections_summary': p.get('corrections_summary').rename(columns={'# of Entries': 'entries'})}
+    # Quarters are numbered consecutively across fiscal years so trends can be compared with arithmetic
+    # Export directories are recorded as absolute paths, so relative and absolute runs of one directory are grouped
+    run = {'run_id': p.run_name, 'export_dir': os.path.realpath(p.export_dir), 'fiscal_year': p.fy, 'fq': p.fq,
+           'quarter': p.fy * 4 + int(p.fq[1]) - 1, 'recorded': pd.Timestamp.now().isoformat(timespec='seconds')}
+
+    con = open_history()
+    try:
+        with con:
+            existing_tables = [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            con.execute('DELETE FROM runs WHERE run_id = ?', (p.run_name,))
+            con.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?)', tuple(run.values()))
+            for table, df in history_dfs.items():
+                if table in existing_tables:
+                    con.execute('DELETE FROM ' + table + ' WHERE run_id = ?', (p.run_name,))
+                df = df.copy()
+                for i, column in enumerate(['run_id', 'fiscal_year', 'fq', 'quarter']):
+                    df.insert(i, column, run[column])
+                append_history(con, table, df)
+                for column in ['run_id', 'quarter'] + history_indexes[table]:
+                    con.execute('CREATE INDEX IF NOT EXISTS ' + table + '_' + column + ' ON ' + table + ' (' +
+                                column + ')')
+    finally:
+        con.close()
+    return {table: len(df) for table, df in history_dfs.items()}
+
+
+# Function to run a SQL query against the history database
+# Returns a dataframe of the query's results, which is empty if no runs have been recorded yet
+# sql: string for the query
+# params: sequence of the query's parameters (default: ())
+# path: string for the database's filepath (default: None, history_path)
+def query_history(sql, params=(), path=None):
+    con = open_history(path)
+    try:
+        if not con.execute('SELECT COUNT(*) FROM runs').fetchone()[0]:
+            return pd.DataFrame()
+        return pd.read_sql_query(sql, con, params=params)
+    finally:
+        con.close()
+
+
+# Function to find staff with coalitions missing surveys in each of the most recent quarters
+# Returns a dataframe of each staff member's email and the number of coalitions missing a survey in each quarter,
+# summed over the quarters, ending with the most recent quarter recorded
+# quarters: int for the number of consecutive quarters (default: 3)
+# export_dir: string to only include runs of one export directory (default: None, every export directory)
+# path: string for the database's filepath (default: None, history_path)
+def outstanding_staff(quarters=3, export_dir=None, path=None):
+    export_dir = export_dir and os.path.realpath(export_dir)
+    return query_history("""
+        WITH recent AS (SELECT * FROM latest_runs WHERE ? IS NULL OR export_dir = ?)
+        SELECT c.reported_by_email, COUNT(DISTINCT c.quarter) AS quarters, COUNT(*) AS coalitions_missing_surveys,
+               MIN(c.fiscal_year || ' ' || c.fq) AS since
+        FROM coalition_corrections c JOIN recent r ON c.run_id = r.run_id
+        WHERE c.quarter > (SELECT MAX(quarter) FROM recent) - ?
+        GROUP BY c.reported_by_email
+        HAVING COUNT(DISTINCT c.quarter) = ?
+        ORDER BY coalitions_missing_surveys DESC, c.reported_by_email""",
+                         (export_dir, export_dir, quarters, quarters), path)
+
+
+# Function to get the Corrections_Sum of every quarter
+# Returns a dataframe of the number of entries of each module and update by export directory and quarter
+# export_dir: string to only include runs of one export directory (default: None, every export directory)
+# path: string for the database's filepath (default: None, history_path)
+def corrections_trend(export_dir=None, path=None):
+    export_dir = export_dir and os.path.realpath(export_dir)
+    return query_history("""
+        SELECT r.export_dir, s.fiscal_year, s.fq, s.module, s."update", s.entries
+        FROM corrections_summary s JOIN latest_runs r ON s.run_id = r.run_id
+        WHERE ? IS NULL OR r.export_dir = ?
+        ORDER BY r.export_dir, s.quarter, s.module, 5""", (export_dir, export_dir), path)
+
+
+# Function to count the coalitions missing surveys in each unit over the most recent quarters
+# Returns a dataframe of the number of coalitions missing surveys by unit and quarter
+# quarters: int for the number of quarters, ending with the most recent quarter recorded (default: 4)
+# export_dir: string to only include runs of one export directory (default: None, every export directory)
+# path: string for the database's filepath (default: None, history_path)
+def unit_trend(quarters=4, export_dir=None, path=None):
+    export_dir = export_dir and os.path.realpath(export_dir)
+    return query_history("""
+        WITH recent AS (SELECT * FROM latest_runs WHERE ? IS NULL OR export_dir = ?)
+        SELECT c.unit, c.fiscal_year, c.fq, COUNT(*) AS coalitions_missing_surveys
+        FROM coalition_corrections c JOIN recent r ON c.run_id = r.run_id
+        WHERE c.quarter > (SELECT MAX(quarter) FROM recent) - ?
+        GROUP BY c.unit, c.quarter
+        ORDER BY c.unit, c.quarter""", (export_dir, export_dir, quarters), path)
+
+
+# Function to get every correction recorded for a coalition
+# Returns a dataframe of the coalition's corrections and corrections of survey responses with its coalition ID,
+# by quarter
+# coalition_id: int for the coalition's ID
+# path: string for the database's filepath (default: None, history_path)
+def coalition_history(coalition_id, path=None):
+    return query_history("""
+        SELECT r.export_dir, c.fiscal_year, c.fq, 'Coalitions' AS module, c.reported_by_email,
+               c.coalition_name, c.updates AS "update"
+        FROM coalition_corrections c JOIN latest_runs r ON c.run_id = r.run_id
+        WHERE c.coalition_id = ?
+        UNION ALL
+        SELECT r.export_dir, s.fiscal_year, s.fq, 'Coalition Surveys', s.reported_by_email, s.coalition_name,
+               s.evaluation_tab_updates
+        FROM survey_corrections s JOIN latest_runs r ON s.run_id = r.run_id
+        WHERE s.coalition_id = ?
+        ORDER BY 1, 2, 3""", (int(coalition_id), int(coalition_id)), path)
 
-write_report(report_file_path, report_dfs)
 
 # Email Survey Notifications
 
@@ -220,6 +1431,8 @@ admin_username = 'your_username@domain.com'
 admin_password = 'your_password'
 admin_send_from = 'your_username@domain.com'
 report_cc = 'list@domain.com, of_recipients@domain.com'
+former_staff_report_recipients = 'recipient@domain.com'
+report_recipients = 'list@domain.com, of_recipients@domain.com'
 
 deadline_date = pd.to_datetime("today").replace(day=19).strftime('%A %b %d, %Y')
 
@@ -249,30 +1462,141 @@ notification_html = """<html>
 </html>
 """
 
+former_staff_html = """<html>
+  <head></head>
+<body>
+            <p>
+            Hello DATA ENTRY SUPPORT et al,<br><br>
+
+            The attached Excel workbook compiles Coalition entries created by former staff that require Coalition Surveys and surveys that require updates.
+            Please complete the updates for each record by <b>5:00pm {0}</b>.          
+            <ul>
+              <li>Use the following link to submit <b>new</b> Coalition Surveys for each Coalition listed below. <a href="https://bit.ly/3qXvAAO">https://bit.ly/3qXvAAO</a></li> 
+              <li>For each entry listed, please make the edit(s) written in the columns labeled <b>UPDATE</b> in the column heading.</li> 
+              <li>You can locate entries in PEARS by entering their IDs into the search filter.</li>              
+            </ul>
+          If you have any questions or need help please reply to this email and a member of the FCS Evaluation Team will reach out soon.
+
+            <br>Thanks and have a great day!<br>       
+            <br> <b> FCS Evaluation Team </b> <br>
+            <a href = "mailto: your_username@domain.com ">your_username@domain.com </a><br>
+
+            </p>
+  </body>
+</html>
+"""
+
+report_html = """<html>
+  <head></head>
+<body>
+            <p>
+            Hello everyone,<br><br>
+
+            The attached reported compiles the most recent round of quarterly Coalition Survey entry.
+            If you have any questions, please reply to this email and a member of the FCS Evaluation Team will reach out soon.<br>
+
+            <br>Thanks and have a great day!<br>       
+            <br> <b> FCS Evaluation Team </b> <br>
+            <a href = "mailto: your_username@domain.com ">your_username@domain.com </a><br>
+            </p>
+  </body>
+</html>
+"""
+
+
+# SMTP server used to send all emails
+# Point these at a local debugging server (e.g. aiosmtpd) to test notifications
+smtp_host = setting('smtp_host', 'smtp.office365.com')
+smtp_port = setting('smtp_port', 587)
+smtp_use_tls = setting('smtp_use_tls', True)
+# Number of messages sent over one SMTP session before reconnecting
+smtp_max_messages = setting('smtp_max_messages', 100)
+
+
+# Class for a reusable authenticated SMTP session
+# One session is opened on the first send and reused for every message until the per-connection cap is reached
+# Dropped sessions are reopened automatically
+# host: string for the SMTP server's hostname
+# port: int for the SMTP server's port
+# username: string for the username to authenticate with (default: None, no authentication)
+# password: string for the password to authenticate with (default: None)
+# is_tls: boolean, True to put the SMTP connection in Transport Layer Security mode (default: True)
+# max_messages: int for the number of messages sent per session, None for no cap (default: 100)
+class MailTransport:
+    def __init__(self, host, port, username=None, password=None, is_tls=True, max_messages=100):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.is_tls = is_tls
+        self.max_messages = max_messages
+        self.smtp = None
+        self.sent_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def connect(self):
+        self.close()
+        smtp = smtplib.SMTP(self.host, self.port)
+        try:
+            if self.is_tls:
+                smtp.starttls(context=ssl.create_default_context())
+            if self.username is not None:
+                smtp.login(self.username, self.password)
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+            raise
+        self.smtp = smtp
+        self.sent_count = 0
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPServerDisconnected, OSError):
+                self.smtp.close()
+            self.smtp = None
+
+    # Send a message, reconnecting if the session was dropped or has reached max_messages
+    # msg: email.message.Message to send
+    # recipients: list of strings for the recipients' email addresses
+    def send(self, msg, recipients):
+        if self.smtp is None or (self.max_messages is not None and self.sent_count >= self.max_messages):
+            self.connect()
+        try:
+            self.smtp.sendmail(msg['From'], recipients, msg.as_string())
+        except smtplib.SMTPServerDisconnected:
+            self.smtp = None
+            self.connect()
+            self.smtp.sendmail(msg['From'], recipients, msg.as_string())
+        self.sent_count += 1
+
 
 # Send an email with or without a xlsx attachment
+# transport: MailTransport for the SMTP session to send with
 # send_from: string for the sender's email address
 # send_to: string for the recipient's email address
 # Cc: string of comma-separated cc addresses
 # subject: string for the email subject line
 # html: string for the email body
-# username: string for the username to authenticate with
-# password: string for the password to authenticate with
-# isTls: boolean, True to put the SMTP connection in Transport Layer Security mode (default: True)
 # wb: boolean, whether an Excel file should be attached to this email (default: False)
 # file_path: string for the xlsx attachment's filepath (default: '')
 # filename: string for the xlsx attachments filename (default: '')
-def send_mail(send_from,
+# attachment: bytes of the xlsx attachment, used instead of reading file_path (default: None)
+def send_mail(transport,
+              send_from,
               send_to,
               cc,
               subject,
               html,
-              username,
-              password,
-              is_tls=True,
               wb=False,
               file_path='',
-              filename=''):
+              filename='',
+              attachment=None):
     msg = MIMEMultipart()
     msg['From'] = send_from
     msg['To'] = send_to
@@ -282,227 +1606,944 @@ def send_mail(send_from,
     msg.attach(MIMEText(html, 'html'))
 
     if wb:
-        fp = open(file_path, 'rb')
+        if attachment is None:
+            with open(file_path, 'rb') as fp:
+                attachment = fp.read()
         part = MIMEBase('application', 'vnd.ms-excel')
-        part.set_payload(fp.read())
-        fp.close()
+        part.set_payload(attachment)
         encoders.encode_base64(part)
         part.add_header('Content-Disposition', 'attachment', filename=filename)
         msg.attach(part)
 
-    smtp = smtplib.SMTP('smtp.office365.com', 587)
-    if is_tls:
-        smtp.starttls()
     try:
-        smtp.login(username, password)
-        smtp.sendmail(send_from, send_to.split(',') + msg['Cc'].split(','), msg.as_string())
+        transport.send(msg, send_to.split(',') + msg['Cc'].split(','))
     except smtplib.SMTPAuthenticationError:
         print("Authentication failed. Make sure to provide a valid username and password.")
-    smtp.quit()
-
-
-# Create dataframe of staff to notify
-notify_staff = Coa_Corrections[['reported_by_email', 'unit']].append(Coa_Survey_Corrections2[['reported_by_email']],
-                                                                     ignore_index=True).drop_duplicates(
-    subset='reported_by_email', keep='first')
-# notify_staff = Coa_Survey_Corrections2[['reported_by_email']].drop_duplicates()
-
-# Subset current staff using the staff list
-current_staff = notify_staff.loc[notify_staff['reported_by_email'].isin(staff['email']), ['reported_by_email', 'unit']]
-current_staff = current_staff.values.tolist()
+        raise
+
+
+# Function to open a new MailTransport with the SMTP settings above
+def new_mail_transport():
+    return MailTransport(smtp_host, smtp_port, admin_username, admin_password, is_tls=smtp_use_tls,
+                         max_messages=smtp_max_messages)
+
+
+# Settings for the notification dispatcher
+# notify_max_workers: number of notifications rendered and sent at once, each worker holds its own SMTP session
+# notify_rate: number of messages sent per second across all workers
+# notify_burst: number of messages that can be sent at once before notify_rate applies
+# notify_max_retries: number of times a message is resent after a transient SMTP error
+# notify_retry_backoff: seconds to wait before the first retry, doubled for each retry after that
+# notify_max_connection_failures: number of consecutive failed connections to the SMTP server after which
+#   the remaining messages are failed without being sent, e.g. when the server is down
+notify_max_workers = setting('notify_max_workers', 4)
+notify_rate = setting('notify_rate', 5.0)
+notify_burst = setting('notify_burst', 10)
+notify_max_retries = setting('notify_max_retries', 3)
+notify_retry_backoff = setting('notify_retry_backoff', 2.0)
+notify_max_connection_failures = setting('notify_max_connection_failures', 5)
+
+
+# Class for a thread-safe token bucket that limits the rate of sends
+# rate: float for the number of tokens added per second
+# capacity: int for the maximum number of tokens held at once
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Block until a token is available, then take it
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Function to determine whether a failed send is worth retrying
+# Dropped connections and 4xx responses are transient, other SMTP errors are not
+# error: exception raised by send_mail
+def is_transient_smtp_error(error):
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return False
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError)) and not isinstance(
+            error, smtplib.SMTPResponseException):
+        return True
+    return isinstance(error, smtplib.SMTPResponseException) and 400 <= error.smtp_code < 500
+
+
+# Function to determine whether a failed send couldn't reach the SMTP server, as opposed to being refused by it
+# error: exception raised by send_mail
+def is_connection_error(error):
+    return isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)) or (
+        isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException))
+
+
+# Function to render and send emails concurrently
+# Returns a dataframe with one row per job: recipient, subject, status ('sent' or 'failed'), attempts, error
+# and latency, the seconds taken by the last send attempt
+# jobs: list of dicts describing each email, each with a 'recipient' key
+# render: function that takes a job and returns the keyword arguments for send_mail besides transport
+# max_workers: int for the number of emails rendered and sent at once (default: notify_max_workers)
+# rate: float for the number of messages sent per second (default: notify_rate)
+# burst: int for the number of messages sent at once before rate applies (default: notify_burst)
+# max_retries: int for the number of resends after a transient SMTP error (default: notify_max_retries)
+# backoff: float for the seconds to wait before the first retry (default: notify_retry_backoff)
+# max_connection_failures: int for the number of consecutive failed connections after which the remaining
+#   emails are failed without being sent (default: notify_max_connection_failures)
+# on_outcome: function called with each job and its outcome as soon as the job is done, e.g. to record it
+#   (default: None)
+def dispatch_emails(jobs,
+                    render,
+                    max_workers=None,
+                    rate=None,
+                    burst=None,
+                    max_retries=None,
+                    backoff=None,
+                    max_connection_failures=None,
+                    on_outcome=None):
+    max_workers = notify_max_workers if max_workers is None else max_workers
+    max_retries = notify_max_retries if max_retries is None else max_retries
+    backoff = notify_retry_backoff if backoff is None else backoff
+    max_connection_failures = (notify_max_connection_failures if max_connection_failures is None
+                               else max_connection_failures)
+    # Consecutive failed connections across all workers, reset by any successful send
+    connection_failures = {'count': 0, 'error': ''}
+    connection_lock = threading.Lock()
+    bucket = TokenBucket(notify_rate if rate is None else rate, notify_burst if burst is None else burst)
+    worker = threading.local()
+    transports = []
+    transports_lock = threading.Lock()
+
+    def get_transport():
+        if not hasattr(worker, 'transport'):
+            worker.transport = new_mail_transport()
+            with transports_lock:
+                transports.append(worker.transport)
+        return worker.transport
+
+    def deliver(job):
+        outcome = send(job)
+        if on_outcome is not None:
+            on_outcome(job, outcome)
+        return outcome
+
+    def send(job):
+        outcome = {'recipient': job.get('recipient', ''), 'subject': '', 'status': 'failed', 'attempts': 0,
+                   'error': '', 'latency': None}
+        try:
+            message = render(job)
+        except Exception as e:
+            # Rendering problems (e.g. a recipient missing from the staff list) fail this email only
+            outcome['error'] = repr(e)
+            return outcome
+        outcome['subject'] = message['subject']
+        for attempt in range(1, max_retries + 2):
+            with connection_lock:
+                if connection_failures['count'] >= max_connection_failures:
+                    # The server is unreachable, so the remaining emails fail without waiting through their retries
+                    outcome['error'] = ('Not sent after ' + str(connection_failures['count']) +
+                                        ' consecutive connection failures: ' + connection_failures['error'])
+                    break
+            bucket.acquire()
+            outcome['attempts'] = attempt
+            sent = time.perf_counter()
+            try:
+                send_mail(get_transport(), **message)
+                outcome['latency'] = time.perf_counter() - sent
+                outcome['status'] = 'sent'
+                outcome['error'] = ''
+                with connection_lock:
+                    connection_failures['count'] = 0
+                break
+            except (smtplib.SMTPException, OSError) as e:
+                outcome['latency'] = time.perf_counter() - sent
+                outcome['error'] = repr(e)
+                with connection_lock:
+                    if is_connection_error(e):
+                        connection_failures['count'] += 1
+                        connection_failures['error'] = repr(e)
+                    else:
+                        # The server was reached, it just refused this email
+                        connection_failures['count'] = 0
+                if attempt > max_retries or not is_transient_smtp_error(e):
+                    break
+                time.sleep(backoff * 2 ** (attempt - 1))
+        return outcome
 
+    try:
+        with ThreadPoolExecutor(max_workers) as executor:
+            outcomes = list(executor.map(deliver, jobs))
+    finally:
+        for transport in transports:
+            transport.close()
+    return pd.DataFrame(outcomes, columns=['recipient', 'subject', 'status', 'attempts', 'error', 'latency'])
+
+
+# Outbox
+
+# Emails are written to a SQLite outbox before they're sent, and each message's state is updated as soon as it's
+# sent or fails, so a send interrupted by a crash or throttling is resumed with send_outbox.py in seconds
+# instead of by rerunning the script
+# Messages are keyed by export directory, fiscal year, quarter, kind and recipient, so rerunning the script for a
+# quarter doesn't email anyone whose message was already sent
+# Senders claim messages before sending them, so a run, watch mode and send_outbox.py can drain the outbox at the
+# same time without sending a message twice
+# A claim lasts outbox_lease seconds and is renewed while its sender is running, so the messages claimed by a sender
+# that died are sent again once its claim runs out, including a message that was being sent when it died
+outbox_path = setting('outbox_path', ROOT_DIR + "/outbox/outbox.db")
+outbox_lease = setting('outbox_lease', 60.0)
+
+
+# Function to open the outbox, creating its messages table if it doesn't exist
+# Returns a sqlite3 connection that can be shared between threads
+# path: string for the outbox's filepath (default: None, outbox_path)
+def open_outbox(path=None):
+    path = outbox_path if path is None else path
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    con = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    # state is 'pending', 'sending', 'sent' or 'failed'
+    # message is the JSON of send_mail's keyword arguments besides the attachment, NULL if it couldn't be rendered
+    # claim identifies the sender that claimed a 'sending' message, claimed is when its claim was last renewed
+    con.execute('CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, key TEXT UNIQUE, run_id TEXT, '
+                'kind TEXT, recipient TEXT, subject TEXT, message TEXT, attachment BLOB, state TEXT, '
+                'attempts INTEGER, error TEXT, queued TEXT, sent TEXT, latency REAL, claim TEXT, claimed TEXT)')
+    # Outboxes created before messages were claimed
+    columns = [column[1] for column in con.execute('PRAGMA table_info(messages)')]
+    for column in ['claim', 'claimed']:
+        if column not in columns:
+            con.execute('ALTER TABLE messages ADD COLUMN ' + column + ' TEXT')
+    con.execute('CREATE INDEX IF NOT EXISTS messages_state ON messages (state)')
+    con.execute('CREATE INDEX IF NOT EXISTS messages_run_id ON messages (run_id)')
+    return con
+
+
+# Function to get the idempotency key of a run's message
+# p: Pipeline the message was created by
+# kind: string for the kind of message, e.g. 'notification'
+# recipient: string for the message's recipient(s)
+def outbox_key(p, kind, recipient):
+    return '|'.join([os.path.realpath(p.export_dir), str(p.fy), p.fq, kind, recipient])
+
+
+# Function to add messages to the outbox
+# A message that was already sent or is being sent is left alone, an unsent one is replaced and queued again
+# Attachments are read into the outbox so messages can be sent without the workbooks they were created with
+# messages: list of dicts with key, kind, recipient and message (send_mail keyword arguments besides transport),
+#   or error instead of message for a message that couldn't be rendered
+# run_name: string for the run id of the messages
+# path: string for the outbox's filepath (default: None, outbox_path)
+def enqueue_messages(messages, run_name, path=None):
+    queued = pd.Timestamp.now().isoformat(timespec='seconds')
+    con = open_outbox(path)
+    try:
+        with con:
+            for outbox_message in messages:
+                message = dict(outbox_message.get('message') or {})
+                attachment = None
+                if message.get('wb'):
+                    with open(message.pop('file_path'), 'rb') as f:
+                        attachment = f.read()
+                con.execute("""
+                    INSERT INTO messages (key, run_id, kind, recipient, subject, message, attachment, state, attempts,
+                                          error, queued)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?)
+                    ON CONFLICT (key) DO UPDATE SET
+                        run_id = excluded.run_id, subject = excluded.subject, message = excluded.message,
+                        attachment = excluded.attachment, state = excluded.state, attempts = 0,
+                        error = excluded.error, queued = excluded.queued, sent = NULL, latency = NULL
+                    WHERE state IN ('pending', 'failed')""",
+                            (outbox_message['key'], run_name, outbox_message['kind'], outbox_message['recipient'],
+                             message.get('subject', ''), json.dumps(message) if message else None, attachment,
+                             'pending' if message else 'failed', outbox_message.get('error', ''), queued))
+    finally:
+        con.close()
+
+
+# Function to send the outbox's pending messages, recording each message's state as soon as it's sent or fails
+# The messages are claimed before they're sent, skipping those claimed by another sender whose claim hasn't run out
+# Returns a dataframe of the outcome of each message sent, like dispatch_emails, with each message's key
+# keys: list of the keys of the messages to send (default: None, every pending message)
+# path: string for the outbox's filepath (default: None, outbox_path)
+def drain_outbox(keys=None, path=None):
+    con = open_outbox(path)
+    lock = threading.Lock()
+    claim = uuid.uuid4().hex
+    done = threading.Event()
+
+    def render(job):
+        message = json.loads(job['message'])
+        if job['attachment'] is not None:
+            message['attachment'] = job['attachment']
+        return message
+
+    def record(job, outcome):
+        with lock, con:
+            # A message whose claim ran out and was taken by another sender is left to that sender
+            con.execute('UPDATE messages SET state = ?, attempts = attempts + ?, error = ?, sent = ?, latency = ? '
+                        "WHERE key = ? AND claim = ? AND state = 'sending'",
+                        ('sent' if outcome['status'] == 'sent' else 'failed', outcome['attempts'], outcome['error'],
+                         pd.Timestamp.now().isoformat(timespec='seconds') if outcome['status'] == 'sent' else None,
+                         outcome['latency'], job['key'], claim))
+
+    # Renew the claim on the messages that haven't been sent yet until they're all done
+    def renew():
+        while not done.wait(outbox_lease / 3):
+            with lock, con:
+                con.execute("UPDATE messages SET claimed = ? WHERE claim = ? AND state = 'sending'",
+                            (pd.Timestamp.now().isoformat(timespec='seconds'), claim))
 
-# Function to subset module corrections for a specific staff member
-# df: dataframe of module corrections
-# former: boolean, True if subsetting corrections for a former staff member
-# staff_email: string for the staff member's email
-def staff_corrections(df, former=True, staff_email=''):
-    if former:
-        return df.loc[df['reported_by_email'].isin(former_staff['reported_by_email'])].reset_index()
-    else:
-        return df.loc[df['reported_by_email'] == staff_email].drop(columns=['reported_by', 'reported_by_email', 'unit'])
+    try:
+        now = pd.Timestamp.now()
+        with lock, con:
+            # BEGIN IMMEDIATE takes the outbox's write lock, so no other sender can claim the same messages
+            con.execute('BEGIN IMMEDIATE')
+            jobs = [{'id': message_id, 'key': key, 'recipient': recipient, 'message': message,
+                     'attachment': attachment}
+                    for message_id, key, recipient, message, attachment in con.execute(
+                        "SELECT id, key, recipient, message, attachment FROM messages WHERE state = 'pending' "
+                        "OR (state = 'sending' AND claimed < ?) ORDER BY id",
+                        ((now - pd.Timedelta(seconds=outbox_lease)).isoformat(timespec='seconds'),))]
+            if keys is not None:
+                keys = set(keys)
+                jobs = [job for job in jobs if job['key'] in keys]
+            con.executemany("UPDATE messages SET state = 'sending', claim = ?, claimed = ? WHERE id = ?",
+                            [(claim, now.isoformat(timespec='seconds'), job['id']) for job in jobs])
+        renewer = threading.Thread(target=renew, daemon=True)
+        renewer.start()
+        try:
+            outcomes = dispatch_emails(jobs, render, on_outcome=record)
+        finally:
+            done.set()
+            renewer.join()
+    finally:
+        con.close()
+    outcomes.insert(0, 'key', [job['key'] for job in jobs])
+    return outcomes
+
+
+# Function to get the state of messages in the outbox
+# Returns a dataframe of each message's key, run_id, kind, recipient, subject, state, attempts, error, queued and
+# sent times and latency
+# keys: list of the keys of the messages, in the order to return them (default: None, every message)
+# path: string for the outbox's filepath (default: None, outbox_path)
+def outbox_status(keys=None, path=None):
+    con = open_outbox(path)
+    try:
+        status = pd.read_sql_query('SELECT key, run_id, kind, recipient, subject, state, attempts, error, queued, '
+                                   'sent, latency FROM messages ORDER BY id', con)
+    finally:
+        con.close()
+    if keys is not None:
+        status = status.set_index('key').loc[keys].reset_index()
+    return status
+
+
+# Function to queue the outbox's failed messages again, except those that couldn't be rendered
+# Returns the number of messages queued
+# run_name: string to only queue messages of one run (default: None, every run)
+# path: string for the outbox's filepath (default: None, outbox_path)
+def retry_failed_messages(run_name=None, path=None):
+    con = open_outbox(path)
+    try:
+        with con:
+            return con.execute("UPDATE messages SET state = 'pending' WHERE state = 'failed' AND message IS NOT NULL "
+                               "AND (? IS NULL OR run_id = ?)", (run_name, run_name)).rowcount
+    finally:
+        con.close()
 
 
-# Function to insert a staff member's corrections into a html email template
-# dfs: dicts of module names to staff members' corrections dataframes for that module
-# strs: list of strings that will be appened to the html email template string
-def insert_dfs(dfs, strs):
-    for heading, df in dfs.items():
-        if not df.empty:
-            strs.append('<h1> ' + heading + ' </h1>' + df.to_html(border=2, justify='center'))
-        else:
-            strs.append('')
+# Create dataframe of staff to notify
+@stage('notify_staff', requires=['coalition_corrections', 'survey_corrections'])
+def find_staff_to_notify(p):
+    return p.get('coalition_corrections')[['reported_by_email', 'unit']].append(
+        p.get('survey_corrections')[['reported_by_email']], ignore_index=True).drop_duplicates(
+        subset='reported_by_email', keep='first')
+    # notify_staff = Coa_Survey_Corrections2[['reported_by_email']].drop_duplicates()
 
 
-# If email fails to send, the recipient is added to this list
-failed_recipients = []
+# Function to partition module corrections by staff member
+# Returns a dict of each reported_by_email to the positions of that staff member's rows in df
+# df: dataframe of module corrections
+def partition_corrections(df):
+    return df.groupby('reported_by_email', sort=False).indices
 
-# Email Update Notifications to current staff
 
-for x in current_staff:
-    recipient = x[0]
-    unit = x[1]
+# Partition corrections once so each staff member's corrections are found without scanning the whole dataframe
+# Returns a dict of module names to the module's corrections and their partitions
+@stage('correction_partitions', requires=['coalition_corrections', 'survey_corrections'])
+def partition_staff_corrections(p):
+    Coa_Corrections = p.get('coalition_corrections')
+    Coa_Survey_Corrections2 = p.get('survey_corrections').drop(columns='response_id')
+    return {'Coalitions': {'corrections': Coa_Corrections, 'by_staff': partition_corrections(Coa_Corrections)},
+            'Coalition Surveys': {'corrections': Coa_Survey_Corrections2,
+                                  'by_staff': partition_corrections(Coa_Survey_Corrections2)}}
 
-    Coa_df = staff_corrections(Coa_Corrections, former=False, staff_email=recipient)
-    PA_df = staff_corrections(Coa_Survey_Corrections2, former=False, staff_email=recipient)
 
-    staff_name = staff.loc[staff['email'] == recipient, 'full_name'].item()
+# Columns of module corrections that aren't shown in staff members' notification emails
+notification_hidden_columns = ['reported_by', 'reported_by_email', 'unit']
 
-    notification_subject = 'Coalition Survey Entry ' + fq + ', ' + staff_name
 
-    response_tag = """If you have any questions or need help please reply to this email and a member of the FCS Evaluation Team will reach out soon.
+# Function to subset module corrections for a specific staff member
+# df: dataframe of module corrections
+# partitions: dict of staff emails to row positions in df from partition_corrections
+# former: boolean, True if subsetting corrections for a former staff member
+# staff_email: string for the staff member's email
+# former_staff: dataframe of former staff with a reported_by_email column, used if former is True (default: None)
+def staff_corrections(df, partitions, former=True, staff_email='', former_staff=None):
+    if former:
+        positions = [partitions[email] for email in former_staff['reported_by_email'] if email in partitions]
+        # Keep the original row order of the module corrections
+        positions = np.sort(np.concatenate(positions)) if positions else []
+        return df.iloc[positions].reset_index()
+    else:
+        return df.iloc[partitions.get(staff_email, [])].drop(columns=notification_hidden_columns, errors='ignore')
+
+
+# Function to split a str.format template with positional fields into its literal text and fields once,
+# so it can be filled in for many emails by joining strings instead of parsing it every time
+# Returns a list of (literal text, field position or None) tuples
+# template: string for the template, e.g. notification_html
+def compile_template(template):
+    return [(literal, None if field is None else int(field))
+            for literal, field, format_spec, conversion in string.Formatter().parse(template)]
+
+
+# Function to fill in a template compiled by compile_template, equivalent to template.format(*values)
+# parts: list of (literal text, field position) tuples from compile_template
+# values: list of values for the template's fields
+def fill_template(parts, values):
+    return ''.join(literal if field is None else literal + str(values[field]) for literal, field in parts)
+
+
+# Class for rendering the notification emails of current staff members
+# Each module's corrections are converted to html with one to_html call, which is split into the table's head
+# and one <tr> block per row, so each staff member's tables are assembled from their rows without calling to_html
+# Every column of the corrections is formatted one value at a time, so the tables match calling to_html on
+# each staff member's corrections
+# The notification template is compiled once and regional specialist response tags are built once per unit
+# p: Pipeline with the correction_partitions and staff_directory stages evaluated
+class NotificationRenderer:
+    def __init__(self, p):
+        self.fq = p.fq
+        self.staff_directory = p.get('staff_directory')
+        self.template = compile_template(notification_html)
+        self.response_tags = {}
+        self.tables = {}
+        for heading, module in p.get('correction_partitions').items():
+            html = module['corrections'].drop(columns=notification_hidden_columns, errors='ignore').to_html(
+                border=2, justify='center')
+            head, body = html.split('<tbody>\n', 1)
+            body, foot = body.rsplit('  </tbody>', 1)
+            rows = np.array(['    <tr>\n' + row for row in body.split('    <tr>\n')[1:]], dtype=object)
+            self.tables[heading] = {'head': '<h1> ' + heading + ' </h1>' + head + '<tbody>\n', 'rows': rows,
+                                    'foot': '  </tbody>' + foot, 'by_staff': module['by_staff']}
+
+    # Returns the html of a staff member's corrections table for a module, or '' if they have none
+    # heading: string for the module's name
+    # recipient: string for the staff member's email
+    def table(self, heading, recipient):
+        table = self.tables[heading]
+        positions = table['by_staff'].get(recipient, [])
+        if not len(positions):
+            return ''
+        return table['head'] + ''.join(table['rows'][positions]) + table['foot']
+
+    # Returns a tuple of the response tag and cc list for a unit's regional specialist, or None if it has none
+    # unit: unit number of the staff member
+    def regional_response_tag(self, unit):
+        if unit not in self.response_tags:
+            regional_educator = self.staff_directory.regional_educator(unit)
+            if regional_educator is None:
+                self.response_tags[unit] = None
+            else:
+                response_tag = 'If you have any questions or need help please contact your Regional Specialist, <b>{0}</b> (<a href = "mailto: {1} ">{1}</a>).'
+                re_name, re_email = regional_educator
+                self.response_tags[unit] = (response_tag.format(*[re_name, re_email]), report_cc + ', ' + re_email)
+        return self.response_tags[unit]
+
+    # Returns the keyword arguments for send_mail of a staff member's notification email
+    # job: dict with the staff member's email ('recipient') and unit ('unit')
+    def render(self, job):
+        recipient = job['recipient']
+        staff_name = self.staff_directory.full_name(recipient)
+
+        notification_subject = 'Coalition Survey Entry ' + self.fq + ', ' + staff_name
+
+        response_tag = """If you have any questions or need help please reply to this email and a member of the FCS Evaluation Team will reach out soon.
             <br>Thanks and have a great day!<br>     
 
             <br> <b> FCS Evaluation Team </b> <br>
             <a href = "mailto: your_username@domain.com ">your_username@domain.com </a><br>
     """
 
-    new_Cc = Cc
-
-    if (unit in re_lookup["UNIT #"].tolist()) and (send_to not in State_Staff['E-MAIL'].tolist()) and (
-            '@uic.edu' not in send_to):
-        response_tag = 'If you have any questions or need help please contact your Regional Specialist, <b>{0}</b> (<a href = "mailto: {1} ">{1}</a>).'
-        re_name = re_lookup.loc[re_lookup['UNIT #'] == unit, 'REGIONAL EDUCATOR'].item()
-        re_email = re_lookup.loc[re_lookup['UNIT #'] == unit, 'NETID/E-MAIL'].item()
-        response_tag = response_tag.format(*[re_name, re_email])
-        new_Cc = Cc + ', ' + re_email
-
-    notification_dfs = {'Coalitions': Coa_df, 'Coalition Surveys': PA_df}
-
-    y = [staff.loc[staff['email'] == recipient, 'first_name'].item(), deadline_date, response_tag]
-
-    insert_dfs(dfs, y)
-    new_notification_html = notification_html.format(*y)
-
-    # Try to send the email, otherwise add the recipient to failed_recipients
-    try:
-        send_mail(send_from=admin_send_from,
-                  send_to=recipient,
-                  cc=new_Cc,
-                  subject=notification_subject,
-                  html=new_notification_html,
-                  username=admin_username,
-                  password=admin_password,
-                  wb=False,
-                  is_tls=True)
-    except smtplib.SMTPException:
-        failed_recipients.append([staff_name, x])
-
-# Email Update Notifications for former staff
-
-# Subset former staff using the staff list
-former_staff = notify_staff.loc[~notify_staff['reported_by_email'].isin(staff['email'])]
-
-Coa_df = staff_corrections(Coa_Corrections, former=True)
-PA_df = staff_corrections(Coa_Survey_Corrections2, former=True)
-
-former_staff_dfs = {'Coalitions': Coa_df, 'Coalition Surveys': PA_df}
-
-former_staff_subject = 'Former Staff Coalition Survey Entry ' + fq
+        new_Cc = report_cc
+
+        regional_response_tag = self.regional_response_tag(job['unit'])
+
+        if (regional_response_tag is not None) and (not self.staff_directory.is_state_staff(recipient)) and (
+                '@uic.edu' not in recipient):
+            response_tag, new_Cc = regional_response_tag
+
+        y = [self.staff_directory.first_name(recipient), deadline_date, response_tag,
+             self.table('Coalitions', recipient), self.table('Coalition Surveys', recipient)]
+
+        return {'send_from': admin_send_from,
+                'send_to': recipient,
+                'cc': new_Cc,
+                'subject': notification_subject,
+                'html': fill_template(self.template, y),
+                'wb': False}
+
+    # Returns a list of the jobs, each with the keyword arguments for send_mail of its email ('message'),
+    # or the exception raised rendering it ('error') so that one email's problem (e.g. a recipient missing from
+    # the staff list) doesn't stop the rest
+    # jobs: list of dicts with each staff member's email ('recipient') and unit ('unit')
+    def render_all(self, jobs):
+        rendered = []
+        for job in jobs:
+            try:
+                rendered.append(dict(job, message=self.render(job)))
+            except Exception as e:
+                rendered.append(dict(job, error=e))
+        return rendered
+
+
+@stage('notification_renderer', requires=['correction_partitions', 'staff_directory'])
+def build_notification_renderer(p):
+    return NotificationRenderer(p)
+
+
+# Notification emails of current staff, rendered and ready to send
+# Returns a list of jobs from NotificationRenderer.render_all
+@stage('notification_messages', requires=['notify_staff', 'staff', 'notification_renderer'])
+def render_notifications(p):
+    notify_staff = p.get('notify_staff')
+    # Subset current staff using the staff list
+    current_staff = notify_staff.loc[notify_staff['reported_by_email'].isin(p.get('staff')['email']),
+                                     ['reported_by_email', 'unit']]
+    current_staff = current_staff.values.tolist()
+
+    notification_jobs = [{'recipient': x[0], 'unit': x[1]} for x in current_staff]
+    return p.get('notification_renderer').render_all(notification_jobs)
+
+
+# Notification emails are written to /notification_previews/<run id> by the notification_previews stage,
+# e.g. to check them before sending with: python pears_coalition_survey_cleaning.py notification_previews
+preview_path = setting('preview_path', ROOT_DIR + "/notification_previews")
+
+
+# Write each notification email to an html file, and a CSV index of their recipients, subjects and files
+# Returns the index as a dataframe
+@stage('notification_previews', requires=['notification_messages'])
+def write_notification_previews(p):
+    preview_dir = preview_path + '/' + p.run_name
+    os.makedirs(preview_dir, exist_ok=True)
+    previews = []
+    for i, job in enumerate(p.get('notification_messages'), 1):
+        preview = {'recipient': job['recipient'], 'cc': '', 'subject': '', 'file': '', 'error': ''}
+        if 'error' in job:
+            preview['error'] = repr(job['error'])
+        else:
+            preview.update(cc=job['message']['cc'], subject=job['message']['subject'],
+                           file=str(i).zfill(4) + '_' + re.sub(r'[^\w.@-]', '_', job['recipient']) + '.html')
+            with open(preview_dir + '/' + preview['file'], 'w', encoding='utf-8') as f:
+                f.write(job['message']['html'])
+        previews.append(preview)
+    previews = pd.DataFrame(previews, columns=['recipient', 'cc', 'subject', 'file', 'error'])
+    previews.to_csv(preview_dir + '/index.csv', index=False)
+    print(str(len(previews)) + ' notification previews written to ' + preview_dir)
+    return previews
 
-former_staff_filename = former_staff_subject + '.xlsx'
-former_staff_file_path = out_path + '/' + former_staff_filename
 
 # Export former staff corrections as an Excel file
-write_report(former_staff_file_path, former_staff_dfs)
-
-# Send former staff updates email
-
-former_staff_report_recipients = 'recipient@domain.com'
+# Returns a dict of the report's file_path, filename, email subject and the dfs written to it
+@stage('former_staff_report', requires=['notify_staff', 'staff', 'correction_partitions'])
+def build_former_staff_report(p):
+    notify_staff = p.get('notify_staff')
+    # Subset former staff using the staff list
+    former_staff = notify_staff.loc[~notify_staff['reported_by_email'].isin(p.get('staff')['email'])]
+
+    corrections = p.get('correction_partitions')
+    Coa_df = staff_corrections(corrections['Coalitions']['corrections'], corrections['Coalitions']['by_staff'],
+                               former=True, former_staff=former_staff)
+    PA_df = staff_corrections(corrections['Coalition Surveys']['corrections'],
+                              corrections['Coalition Surveys']['by_staff'], former=True, former_staff=former_staff)
+
+    former_staff_dfs = {'Coalitions': Coa_df, 'Coalition Surveys': PA_df}
+
+    former_staff_subject = 'Former Staff Coalition Survey Entry ' + p.fq
+
+    former_staff_filename = former_staff_subject + '.xlsx'
+    former_staff_file_path = p.out_dir + '/' + former_staff_filename
+
+    write_report(former_staff_file_path, former_staff_dfs)
+    return {'file_path': former_staff_file_path, 'filename': former_staff_filename, 'subject': former_staff_subject,
+            'dfs': former_staff_dfs}
+
+
+# Write the notifications to current staff, the former staff report email and the corrections report email
+# to the outbox
+# Returns a dataframe of the key, kind and recipient of each message, in the order they're sent
+@stage('outbox', requires=['notification_messages', 'corrections_report', 'former_staff_report'])
+def fill_outbox(p):
+    messages = []
+    for job in p.get('notification_messages'):
+        outbox_message = {'key': outbox_key(p, 'notification', job['recipient']), 'kind': 'notification',
+                          'recipient': job['recipient']}
+        if 'error' in job:
+            outbox_message['error'] = repr(job['error'])
+        else:
+            outbox_message['message'] = job['message']
+        messages.append(outbox_message)
+
+    # Former staff updates email
+    former_staff_report = p.get('former_staff_report')
+
+    y = [deadline_date]
+
+    new_former_staff_html = former_staff_html.format(*y)
+
+    if not former_staff_report['dfs']['Coalitions'].empty:
+        former_staff_email = {'send_from': admin_send_from,
+                              'send_to': former_staff_report_recipients,
+                              'cc': report_cc,
+                              'subject': former_staff_report['subject'],
+                              'html': new_former_staff_html,
+                              'wb': True,
+                              'file_path': former_staff_report['file_path'],
+                              'filename': former_staff_report['filename']}
+        messages.append({'key': outbox_key(p, 'former_staff_report', former_staff_report_recipients),
+                         'kind': 'former_staff_report', 'recipient': former_staff_report_recipients,
+                         'message': former_staff_email})
+
+    report = p.get('corrections_report')
+
+    report_subject = 'Quarterly Coalition Survey Entry Q2 ' + p.fq
+
+    report_email = {'send_from': admin_send_from,
+                    'send_to': report_recipients,
+                    'cc': report_cc,
+                    'subject': report_subject,
+                    'html': report_html,
+                    'wb': True,
+                    'file_path': report['file_path'],
+                    'filename': report['filename']}
+    messages.append({'key': outbox_key(p, 'corrections_report', report_recipients), 'kind': 'corrections_report',
+                     'recipient': report_recipients, 'message': report_email})
+
+    enqueue_messages(messages, p.run_name)
+    return pd.DataFrame(messages, columns=['key', 'kind', 'recipient'])
+
+
+# Send the run's messages in the outbox, skipping any already sent by an earlier run of the same quarter
+# Returns a dataframe recording whether each email was sent, also written to the run log
+@stage('notifications', requires=['outbox'])
+def send_notifications(p):
+    outbox = p.get('outbox')
+    already_sent = (outbox_status(outbox['key'].tolist())['state'] == 'sent').sum()
+    drain_outbox(outbox['key'].tolist())
+    status = outbox_status(outbox['key'].tolist())
+    if already_sent:
+        print(str(already_sent) + ' message(s) already sent by an earlier run were skipped.')
+    being_sent = (status['state'] == 'sending').sum()
+    if being_sent:
+        print(str(being_sent) + ' message(s) claimed by another sender (e.g. send_outbox.py) were left to it.')
+    notification_outcomes = status.rename(columns={'state': 'status'})[
+        ['recipient', 'subject', 'status', 'attempts', 'error', 'latency', 'key']]
+    # The send log is written before the failure notice, so it's kept if the notice can't be sent either
+    os.makedirs(run_log_path, exist_ok=True)
+    notification_outcomes.to_csv(run_log_path + '/' + p.run_name + '_emails.csv', index=False)
+
+    report_outcome = notification_outcomes.loc[outbox['kind'] == 'corrections_report']
+    if (report_outcome['status'] == 'failed').any():
+        print("Failed to send report to Regional Specialists.")
+
+    failed_recipients = notification_outcomes.loc[notification_outcomes['status'] == 'failed']
+
+    if not failed_recipients.empty:
+        fail_html = """The following recipients failed to receive an email:<br>
+    {}    
+    """
+        new_string = failed_recipients[['recipient', 'subject', 'attempts', 'error']].to_html(index=False)
+        new_fail_html = fail_html.format(new_string)
+        try:
+            with new_mail_transport() as transport:
+                send_mail(transport,
+                          send_from=admin_send_from,
+                          send_to=admin_send_from,
+                          cc=report_cc,
+                          subject='Coalition Survey Entry ' + p.fq + ' Failure Notice',
+                          html=new_fail_html,
+                          wb=False)
+        except (smtplib.SMTPException, OSError) as e:
+            print('Failed to send the failure notice: ' + repr(e) + '. Failed emails are listed in ' + run_log_path +
+                  '/' + p.run_name + '_emails.csv.')
+    else:
+        print("Data cleaning notifications sent successfully.")
 
-former_staff_html = """<html>
-  <head></head>
-<body>
-            <p>
-            Hello DATA ENTRY SUPPORT et al,<br><br>
+    return notification_outcomes
 
-            The attached Excel workbook compiles Coalition entries created by former staff that require Coalition Surveys and surveys that require updates.
-            Please complete the updates for each record by <b>5:00pm {0}</b>.          
-            <ul>
-              <li>Use the following link to submit <b>new</b> Coalition Surveys for each Coalition listed below. <a href="https://bit.ly/3qXvAAO">https://bit.ly/3qXvAAO</a></li> 
-              <li>For each entry listed, please make the edit(s) written in the columns labeled <b>UPDATE</b> in the column heading.</li> 
-              <li>You can locate entries in PEARS by entering their IDs into the search filter.</li>              
-            </ul>
-          If you have any questions or need help please reply to this email and a member of the FCS Evaluation Team will reach out soon.
 
-            <br>Thanks and have a great day!<br>       
-            <br> <b> FCS Evaluation Team </b> <br>
-            <a href = "mailto: your_username@domain.com ">your_username@domain.com </a><br>
+# Stages evaluated when the script is run without naming any
+# The corrections history is recorded before emails are sent, so it isn't lost if sending fails
+default_stages = ['history', 'notifications']
 
-            </p>
-  </body>
-</html>
-"""
-y = [deadline_date]
 
-new_former_staff_html = former_staff_html.format(*y)
+# Batch mode runs the pipeline for several export directories and fiscal quarters, e.g. to rerun past quarters
+# or to process several implementing agencies' exports
+# batch_max_workers: number of jobs run at once, each in its own worker process
+batch_max_workers = setting('batch_max_workers', 2)
+# batch_max_memory_mb: memory each job may allocate in MB, a job that exceeds it fails with a MemoryError
+# (default: 0, no limit; only enforced on Linux)
+batch_max_memory_mb = setting('batch_max_memory_mb', 0)
 
-try:
-    if not Coa_df.empty:
-        send_mail(send_from=admin_send_from,
-                  send_to=former_staff_report_recipients,
-                  cc=Cc,
-                  subject=former_staff_subject,
-                  html=new_former_staff_html,
-                  username=admin_username,
-                  password=admin_password,
-                  wb=True,
-                  file_path=former_staff_file_path,
-                  filename=former_staff_filename,
-                  is_tls=True)
-except smtplib.SMTPException:
-    failed_recipients.append(['DATA ENTRY SUPPORT NAME', former_staff_report_recipients])
+# Stages evaluated for each job when none are named
+# Notifications are only sent in batch mode when the notifications stage is named
+batch_default_stages = ['history', 'corrections_report', 'former_staff_report']
 
-report_recipients = 'list@domain.com, of_recipients@domain.com'
+# Stages that only depend on the workbooks in inputs_dir, evaluated once and shared with every job
+batch_shared_stages = ['staff', 're_lookup', 'staff_directory', 'unit_counties', 'unit_resolver', 'update_notes']
 
-report_subject = 'Quarterly Coalition Survey Entry Q2 ' + fq
+# Results of batch_shared_stages in a batch worker process, set by init_batch_worker
+batch_shared = {}
 
-report_html = """<html>
-  <head></head>
-<body>
-            <p>
-            Hello everyone,<br><br>
 
-            The attached reported compiles the most recent round of quarterly Coalition Survey entry.
-            If you have any questions, please reply to this email and a member of the FCS Evaluation Team will reach out soon.<br>
+# Function to give a batch worker process the shared stage results and limit its memory
+# Forked workers inherit the results from the parent process, spawned workers receive a pickled copy
+# shared: dict of stage names to results
+def init_batch_worker(shared):
+    global batch_shared
+    batch_shared = shared
+    if batch_max_memory_mb and os.path.exists('/proc/self/statm'):
+        # The limit is on the worker's address space, which already includes the shared results
+        with open('/proc/self/statm') as statm:
+            address_space = int(statm.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+        hard_limit = resource.getrlimit(resource.RLIMIT_AS)[1]
+        limit = address_space + int(batch_max_memory_mb * 1024 * 1024)
+        if hard_limit != resource.RLIM_INFINITY:
+            limit = min(limit, hard_limit)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard_limit))
 
-            <br>Thanks and have a great day!<br>       
-            <br> <b> FCS Evaluation Team </b> <br>
-            <a href = "mailto: your_username@domain.com ">your_username@domain.com </a><br>
-            </p>
-  </body>
-</html>
-"""
 
-try:
-    send_mail(send_from=admin_send_from,
-              send_to=report_recipients,
-              cc=Cc,
-              subject=report_subject,
-              html=report_html,
-              username=admin_username,
-              password=admin_password,
-              wb=True,
-              file_path=report_file_path,
-              filename=report_filename,
-              is_tls=True)
-except smtplib.SMTPException:
-    print("Failed to send report to Regional Specialists.")
-
-if failed_recipients:
-    fail_html = """The following recipients failed to receive an email:<br>
-    {}    
-    """
-    new_string = '<br>'.join(map(str, failed_recipients))
-    new_fail_html = html.format(new_string)
-    send_mail(send_from=admin_send_from,
-              send_to=admin_send_from,
-              cc=Cc,
-              subject='Coalition Survey Entry ' + fq + ' Failure Notice',
-              html=new_fail_html,
-              username=admin_username,
-              password=admin_password,
-              wb=False,
-              is_tls=True)
-else:
-    print("Data cleaning notifications sent successfully.")
+# Function to run one batch job in a worker process
+# Returns a tuple of the job, the job's Corrections_Sum and an error message, '' if the job succeeded
+# job: dict with export_dir, fq, out_dir and run_name keys, and optionally fiscal_year
+# targets: list of stage names to evaluate
+def run_batch_job(job, targets):
+    try:
+        os.makedirs(job['out_dir'], exist_ok=True)
+        pipeline = Pipeline(job['export_dir'], fq=job['fq'], out_dir=job['out_dir'], run_name=job['run_name'],
+                            fy=job.get('fiscal_year'), results=batch_shared)
+        pipeline.get_all(targets)
+        return job, pipeline.get('corrections_summary'), ''
+    except Exception as e:
+        # A missing or malformed export only fails its own job
+        return job, None, repr(e)
+
+
+# Function to run one batch job in a new worker process, which exits after the job
+# A worker that is killed, e.g. for exceeding batch_max_memory_mb in native code, only fails its own job
+# Returns the result of run_batch_job
+# job: dict with export_dir, fq, out_dir and run_name keys, and optionally fiscal_year
+# targets: list of stage names to evaluate
+# shared: dict of batch_shared_stages names to results
+def run_batch_job_process(job, targets, shared):
+    mp_context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(1, mp_context=mp_context, initializer=init_batch_worker, initargs=(shared,)) as executor:
+        try:
+            return executor.submit(run_batch_job, job, targets).result()
+        except BrokenProcessPool:
+            error = 'worker process exited unexpectedly'
+            return job, None, error + (', e.g. after exceeding batch_max_memory_mb' if batch_max_memory_mb else '')
+
+
+# Function to run the pipeline for a list of jobs in parallel
+# The staff list, unit counties and Update Notifications are read and consolidated once and shared with each job
+# Each worker process runs one job and then exits, so a job's memory is released before the next job starts,
+# and batch_max_memory_mb limits the memory of each job
+# Returns the Corrections_Sum of every job in one dataframe with export_dir and fq columns,
+# which is also written to 'Batch Corrections Summary <run_id>.xlsx' in out_path
+# jobs: list of dicts with the export_dir, fq and out_dir of each job, and optionally its fiscal_year
+# targets: list of stage names to evaluate for each job (default: None, batch_default_stages)
+# max_workers: int for the number of jobs run at once (default: batch_max_workers)
+def run_batch(jobs, targets=None, max_workers=None):
+    targets = targets or batch_default_stages
+    max_workers = batch_max_workers if max_workers is None else max_workers
+    jobs = [dict(job, fq=quarter_labels(job['fq'])[0], run_name=run_id + '_' + str(i + 1))
+            for i, job in enumerate(jobs)]
+
+    shared_pipeline = Pipeline(fq=jobs[0]['fq'], run_name=run_id + '_shared')
+    shared = dict(zip(batch_shared_stages, shared_pipeline.get_all(batch_shared_stages)))
+
+    with ThreadPoolExecutor(min(max_workers, len(jobs))) as executor:
+        results = list(executor.map(run_batch_job_process, jobs, [targets] * len(jobs), [shared] * len(jobs)))
+
+    summaries = []
+    for job, Corrections_Sum, error in results:
+        if error:
+            print('Batch job ' + job['export_dir'] + ' ' + job['fq'] + ' failed: ' + error)
+            continue
+        Corrections_Sum = Corrections_Sum.copy()
+        Corrections_Sum.insert(0, 'fq', job['fq'])
+        Corrections_Sum.insert(0, 'export_dir', job['export_dir'])
+        summaries.append(Corrections_Sum)
+    if not summaries:
+        return pd.DataFrame()
+
+    Batch_Sum = pd.concat(summaries, ignore_index=True)
+    os.makedirs(out_path, exist_ok=True)
+    write_report(out_path + '/Batch Corrections Summary ' + run_id + '.xlsx', {'Corrections Summary': Batch_Sum})
+    print(Batch_Sum[['export_dir', 'fq', 'Module', 'Update', '# of Entries']].to_string(index=False))
+    return Batch_Sum
+
+
+# Watch mode keeps the pipeline's sheets and results in memory and reprocesses the exports whenever they change
+# watch_interval: seconds between checks of the workbooks
+# watch_settle: seconds a changed workbook must go unmodified before it's read, so exports still being written
+#   aren't read
+# notify_trigger: name of the file that, when created in the export directory, sends the notifications
+watch_interval = setting('watch_interval', 5.0)
+watch_settle = setting('watch_settle', 10.0)
+notify_trigger = setting('notify_trigger', 'send_notifications')
+
+# Stages evaluated in watch mode when workbooks change
+# Notifications aren't sent until the notify_trigger file is created
+watch_stages = ['history', 'corrections_report', 'notification_messages']
+
+
+# Function to get the size and modified time of each of a pipeline's workbooks
+# Returns a dict of filepaths to (size, modified time in ns) tuples, or None for workbooks that don't exist
+# pipeline: Pipeline whose input_sources workbooks are checked
+def workbook_signatures(pipeline):
+    signatures = {}
+    for file_path in {source['file_path'] for source in pipeline.sources.values()}:
+        try:
+            stat = os.stat(file_path)
+            signatures[file_path] = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            signatures[file_path] = None
+    return signatures
+
+
+# Function to run the pipeline in watch mode until it's interrupted, e.g. with Ctrl+C
+# Changed workbooks are processed once their sizes and modified times have been unchanged for watch_settle seconds
+# Only the changed workbooks' sheets are read again and only the stages that depend on them are evaluated again,
+# each time under a new run id
+# A new pipeline is started when the most recently completed quarter changes, unless fiscal_quarter is set
+# Failed runs are reported and retried when the workbooks change again
+# Returns the Pipeline
+# targets: list of stage names evaluated when workbooks change (default: None, watch_stages)
+def watch(targets=None):
+    targets = targets or watch_stages
+    pipeline = Pipeline()
+    # Signatures of the workbooks the pipeline's results were evaluated from, and as of the previous check
+    processed = {}
+    previous = {}
+    print('Watching ' + pipeline.export_dir + ' for changed exports. Create ' + notify_trigger +
+          ' in the export directory to send notifications.')
+    try:
+        while True:
+            if not fiscal_quarter and quarter_labels()[0] != pipeline.fq:
+                # Results that only depend on inputs_dir are kept for the new quarter
+                pipeline = Pipeline(results={name: pipeline.results[name] for name in batch_shared_stages
+                                             if name in pipeline.results})
+                processed = {}
+
+            signatures = workbook_signatures(pipeline)
+            changed = [file_path for file_path, signature in signatures.items()
+                       if file_path not in processed or processed[file_path] != signature]
+            now = time.time_ns()
+            settled = all(signatures[file_path] == previous.get(file_path) and (
+                    signatures[file_path] is None or now - signatures[file_path][1] >= watch_settle * 1e9)
+                          for file_path in changed)
+            previous = signatures
+
+            if changed and settled:
+                started = time.perf_counter()
+                pipeline.run_name = pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')
+                pipeline.timer = StageTimer(pipeline.run_name)
+                pipeline.invalidate([name for name, source in pipeline.sources.items()
+                                     if source['file_path'] in changed])
+                processed.update({file_path: signatures[file_path] for file_path in changed})
+                print('Changed: ' + ', '.join(sorted(os.path.basename(file_path) for file_path in changed)) +
+                      ' (' + str(len(pipeline.plan(targets))) + ' stage(s) to evaluate)')
+                try:
+                    pipeline.get_all(targets)
+                    print('Run ' + pipeline.run_name + ' finished in ' +
+                          format(time.perf_counter() - started, '.1f') + ' s.')
+                except Exception as e:
+                    print('Run ' + pipeline.run_name + ' failed: ' + repr(e))
+
+            # Notifications are sent from the latest results once every changed workbook has been processed
+            trigger_path = pipeline.export_dir + '/' + notify_trigger
+            if not changed and os.path.exists(trigger_path):
+                os.remove(trigger_path)
+                try:
+                    pipeline.get('notifications')
+                except Exception as e:
+                    print('Sending notifications failed: ' + repr(e))
+                # The outbox is filled again for the next trigger, so it can send messages that failed
+                pipeline.invalidate(['outbox'])
+
+            time.sleep(watch_interval)
+    except KeyboardInterrupt:
+        print('Watch mode stopped.')
+    return pipeline
+
+
+# Function to run the script from the command line
+# Evaluates the stages named as arguments and the stages they require, by default every stage
+# Returns the Pipeline, or the consolidated Corrections_Sum in batch mode
+# argv: list of strings for the command line arguments (default: None, sys.argv)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Clean PEARS Coalition Survey data, write the corrections reports '
+                                                 'and email staff their corrections.')
+    parser.add_argument('stages', nargs='*', metavar='stage',
+                        help='stages to evaluate (default: ' + ', '.join(default_stages) + '), one of: ' +
+                             ', '.join(stages))
+    parser.add_argument('--job', nargs=3, action='append', default=[], metavar=('EXPORT_DIR', 'FQ', 'OUT_DIR'),
+                        help='run in batch mode, repeat for each export directory and fiscal quarter (default '
+                             'stages: ' + ', '.join(batch_default_stages) + ')')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running, evaluate the stages (default: ' + ', '.join(watch_stages) + ') whenever '
+                             'the export workbooks change, and send notifications when the ' + notify_trigger +
+                             ' file is created in the export directory')
+    parser.add_argument('--jobs-file',
+                        help='run in batch mode with the jobs listed in a CSV file with export_dir, fq and out_dir '
+                             'columns, and optionally fiscal_year')
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.stages if name not in stages]
+    if unknown:
+        parser.error('unknown stage(s): ' + ', '.join(unknown))
+
+    jobs = [{'export_dir': export_dir, 'fq': fq, 'out_dir': out_dir} for export_dir, fq, out_dir in args.job]
+    if args.jobs_file:
+        jobs_file = pd.read_csv(args.jobs_file, dtype=str)
+        jobs_file = jobs_file[[column for column in ['export_dir', 'fq', 'out_dir', 'fiscal_year'] if column in jobs_file]]
+        # A blank fiscal_year defaults to the most recent one
+        jobs += [{key: value for key, value in job.items() if pd.notnull(value)}
+                 for job in jobs_file.to_dict('records')]
+    if jobs and args.watch:
+        parser.error('--watch can\'t be used in batch mode')
+    if jobs:
+        return run_batch(jobs, args.stages)
+    if args.watch:
+        return watch(args.stages)
+
+    pipeline = Pipeline()
+    pipeline.get_all(args.stages or default_stages)
+    return pipeline
+
+
+if __name__ == '__main__':
+    main()
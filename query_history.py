@@ -0,0 +1,52 @@
+import argparse
+import pandas as pd
+
+from pears_coalition_survey_cleaning import (history_path, outstanding_staff, corrections_trend, unit_trend,
+                                             coalition_history)
+
+# Reports on the corrections history recorded by pears_coalition_survey_cleaning.py
+# Each report queries the most recent run of every export directory and quarter
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the coalition survey corrections history.')
+    # Options shared by every report
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--db', default=history_path, help='path to the history database')
+    common.add_argument('--csv', help='write the report to a CSV file instead of printing it')
+    reports = parser.add_subparsers(dest='report', required=True)
+    outstanding = reports.add_parser('outstanding', parents=[common],
+                                     help='staff with coalitions missing surveys in each of the most recent quarters')
+    outstanding.add_argument('--quarters', type=int, default=3, help='number of consecutive quarters')
+    outstanding.add_argument('--export-dir', help='only include runs of this export directory')
+    trend = reports.add_parser('trend', parents=[common], help='corrections summary of every quarter')
+    trend.add_argument('--export-dir', help='only include runs of this export directory')
+    units = reports.add_parser('units', parents=[common],
+                               help='coalitions missing surveys by unit over the most recent quarters')
+    units.add_argument('--quarters', type=int, default=4, help='number of quarters')
+    units.add_argument('--export-dir', help='only include runs of this export directory')
+    coalition = reports.add_parser('coalition', parents=[common], help='every correction recorded for a coalition')
+    coalition.add_argument('coalition_id', type=int)
+    args = parser.parse_args()
+
+    if args.report == 'outstanding':
+        report = outstanding_staff(args.quarters, args.export_dir, args.db)
+    elif args.report == 'trend':
+        report = corrections_trend(args.export_dir, args.db)
+    elif args.report == 'units':
+        report = unit_trend(args.quarters, args.export_dir, args.db)
+    else:
+        report = coalition_history(args.coalition_id, args.db)
+
+    # Trends are shown with one column per quarter
+    if args.report == 'trend' and not report.empty:
+        report = report.pivot_table(index=['export_dir', 'module', 'update'], columns=['fiscal_year', 'fq'],
+                                    values='entries', aggfunc='sum')
+    elif args.report == 'units' and not report.empty:
+        report = report.pivot_table(index='unit', columns=['fiscal_year', 'fq'], values='coalitions_missing_surveys',
+                                    aggfunc='sum', fill_value=0)
+
+    if args.csv:
+        report.to_csv(args.csv, index=isinstance(report.index, pd.MultiIndex) or report.index.name is not None)
+    else:
+        with pd.option_context('display.max_rows', None, 'display.width', 200):
+            print(report.to_string() if not report.empty else 'No corrections recorded.')
@@ -4,6 +4,14 @@ docker build -t il_fcs/pears_coalition_survey_cleaning:latest .
 docker run --name pears_coalition_survey_cleaning il_fcs/pears_coalition_survey_cleaning:latest
 :: Copy /example_outputs from the container to the build context
 docker cp pears_coalition_survey_cleaning:/pears_coalition_survey_cleaning/example_outputs/ ./
+:: Copy /sheet_cache from the container so unchanged workbooks aren't parsed again on the next build
+docker cp pears_coalition_survey_cleaning:/pears_coalition_survey_cleaning/sheet_cache/ ./
+:: Copy /history from the container so the next run appends to the corrections history
+docker cp pears_coalition_survey_cleaning:/pears_coalition_survey_cleaning/history/ ./
+:: Copy /outbox from the container so unsent emails can be resumed and sent emails aren't sent again
+docker cp pears_coalition_survey_cleaning:/pears_coalition_survey_cleaning/outbox/ ./
+:: Copy /run_logs from the container to the build context
+docker cp pears_coalition_survey_cleaning:/pears_coalition_survey_cleaning/run_logs/ ./
 :: Remove the container
 docker rm pears_coalition_survey_cleaning
 pause
\ No newline at end of file
@@ -0,0 +1,32 @@
+import argparse
+import pandas as pd
+
+from pears_coalition_survey_cleaning import outbox_path, drain_outbox, outbox_status, retry_failed_messages
+
+# Sends the messages waiting in the outbox written by pears_coalition_survey_cleaning.py
+# Use to resume sending after the script was interrupted or emails failed, without rerunning the script
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Send the pending messages in the coalition survey email outbox.')
+    parser.add_argument('--db', default=outbox_path, help='path to the outbox')
+    parser.add_argument('--status', action='store_true', help='show the number of messages in each state and exit')
+    parser.add_argument('--retry-failed', action='store_true', help='queue failed messages again before sending')
+    parser.add_argument('--run', help='only retry the failed messages of this run id')
+    args = parser.parse_args()
+
+    if not args.status:
+        if args.retry_failed:
+            print(str(retry_failed_messages(args.run, args.db)) + ' failed message(s) queued again.')
+        outcomes = drain_outbox(path=args.db)
+        print(str((outcomes['status'] == 'sent').sum()) + ' message(s) sent, ' +
+              str((outcomes['status'] == 'failed').sum()) + ' failed.')
+        failed = outcomes.loc[outcomes['status'] == 'failed', ['recipient', 'subject', 'attempts', 'error']]
+        if not failed.empty:
+            with pd.option_context('display.max_colwidth', 80, 'display.width', 200):
+                print(failed.to_string(index=False))
+
+    status = outbox_status(path=args.db)
+    if status.empty:
+        print('The outbox is empty.')
+    else:
+        print(status.groupby(['run_id', 'state']).size().unstack(fill_value=0).to_string())
@@ -0,0 +1,16 @@
+:: Build the Docker image for pears_coalition_survey_cleaning.py
+docker build -t il_fcs/pears_coalition_survey_cleaning:latest .
+:: Start the script in watch mode in a container that keeps running and restarts with Docker Desktop
+:: The export, output, cache, history, outbox and run log directories are mounted from the build context,
+:: so new exports are seen by the container and results are kept when it is removed
+docker run -d --restart unless-stopped --name pears_coalition_survey_watch ^
+  -v "%cd%\example_inputs":/pears_coalition_survey_cleaning/example_inputs ^
+  -v "%cd%\example_outputs":/pears_coalition_survey_cleaning/example_outputs ^
+  -v "%cd%\sheet_cache":/pears_coalition_survey_cleaning/sheet_cache ^
+  -v "%cd%\history":/pears_coalition_survey_cleaning/history ^
+  -v "%cd%\outbox":/pears_coalition_survey_cleaning/outbox ^
+  -v "%cd%\run_logs":/pears_coalition_survey_cleaning/run_logs ^
+  il_fcs/pears_coalition_survey_cleaning:latest python -u ./pears_coalition_survey_cleaning.py --watch
+:: Show the container's output, stop it with: docker rm -f pears_coalition_survey_watch
+docker logs pears_coalition_survey_watch
+pause
\ No newline at end of file